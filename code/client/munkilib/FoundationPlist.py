@@ -45,6 +45,7 @@ from Foundation import (
     NSPropertyListSerialization,
     NSPropertyListMutableContainers,
     NSPropertyListXMLFormat_v1_0,
+    NSPropertyListBinaryFormat_v1_0,
 )
 
 
@@ -98,15 +99,21 @@ def readPlistFromString(data):
         return dataObject
 
 
-def writePlist(dataObject, filepath):
+def writePlist(dataObject, filepath, binary=False):
     """
     Write 'rootObject' as a plist to filepath.
+    If binary is True, write a binary plist instead of an XML one;
+    these are smaller and quicker to read, but not human-readable.
     """
+    if binary:
+        plistFormat = NSPropertyListBinaryFormat_v1_0
+    else:
+        plistFormat = NSPropertyListXMLFormat_v1_0
     (
         plistData,
         error,
     ) = NSPropertyListSerialization.dataFromPropertyList_format_errorDescription_(
-        dataObject, NSPropertyListXMLFormat_v1_0, None
+        dataObject, plistFormat, None
     )
     if error:
         error = error.encode("ascii", "ignore")
@@ -120,13 +127,19 @@ def writePlist(dataObject, filepath):
             )
 
 
-def writePlistToString(rootObject):
-    """Return 'rootObject' as a plist-formatted string."""
+def writePlistToString(rootObject, binary=False):
+    """Return 'rootObject' as a plist-formatted string.
+    If binary is True, return a binary plist instead of an XML one.
+    """
+    if binary:
+        plistFormat = NSPropertyListBinaryFormat_v1_0
+    else:
+        plistFormat = NSPropertyListXMLFormat_v1_0
     (
         plistData,
         error,
     ) = NSPropertyListSerialization.dataFromPropertyList_format_errorDescription_(
-        rootObject, NSPropertyListXMLFormat_v1_0, None
+        rootObject, plistFormat, None
     )
     if error:
         error = error.encode("ascii", "ignore")
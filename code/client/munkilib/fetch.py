@@ -27,6 +27,7 @@ import os
 import re
 import shutil
 import subprocess
+import tempfile
 import time
 import urllib2
 import urlparse
@@ -96,7 +97,8 @@ WARNINGSLOGGED = {}
 
 def curl(url, destinationpath,
          cert_info=None, custom_headers=None, donotrecurse=False, etag=None,
-         message=None, onlyifnewer=False, resume=False, follow_redirects=False):
+         message=None, onlyifnewer=False, resume=False, follow_redirects=False,
+         show_progress=True):
     """Gets an HTTP or HTTPS URL and stores it in
     destination path. Returns a dictionary of headers, which includes
     http_result_code and http_result_description.
@@ -110,19 +112,23 @@ def curl(url, destinationpath,
     Finally, if you set resume to True, curl will attempt to resume an
     interrupted download. You'll get an error if the existing file is
     complete; if the file has changed since the first download attempt, you'll
-    get a mess."""
+    get a mess.
+    Set show_progress to False to skip the percent-done display, as when
+    several downloads run at once."""
 
     header = {}
     header['http_result_code'] = '000'
     header['http_result_description'] = ''
 
-    curldirectivepath = os.path.join(munkicommon.tmpdir, 'curl_temp')
     tempdownloadpath = destinationpath + '.download'
 
     # we're writing all the curl options to a file and passing that to
-    # curl so we avoid the problem of URLs showing up in a process listing
+    # curl so we avoid the problem of URLs showing up in a process listing.
+    # Each call gets its own file, since downloads may run concurrently.
     try:
-        fileobj = open(curldirectivepath, mode='w')
+        fd, curldirectivepath = tempfile.mkstemp(prefix='curl_temp',
+                                                 dir=munkicommon.tmpdir)
+        fileobj = os.fdopen(fd, 'w')
         print >> fileobj, 'silent'          # no progress meter
         print >> fileobj, 'show-error'      # print error msg to stderr
         print >> fileobj, 'no-buffer'       # don't buffer output
@@ -277,7 +283,9 @@ def curl(url, destinationpath,
                 if percent != downloadedpercent:
                     # percent changed; update display
                     downloadedpercent = percent
-                    munkicommon.display_percent_done(downloadedpercent, 100)
+                    if show_progress:
+                        munkicommon.display_percent_done(
+                            downloadedpercent, 100)
             time.sleep(0.1)
         else:
             # Headers have finished, but not targetsize or HTTP2xx.
@@ -289,6 +297,10 @@ def curl(url, destinationpath,
             break
 
     retcode = proc.poll()
+    try:
+        os.unlink(curldirectivepath)
+    except OSError:
+        pass
     if retcode:
         curlerr = ''
         try:
@@ -328,6 +340,7 @@ def curl(url, destinationpath,
                                 custom_headers=custom_headers,
                                 donotrecurse=True,
                                 etag=etag,
+                                show_progress=show_progress,
                                 message=message,
                                 onlyifnewer=onlyifnewer,
                                 resume=resume,
@@ -371,7 +384,7 @@ def curl(url, destinationpath,
                 temp_download_exists:
             downloadedsize = os.path.getsize(tempdownloadpath)
             if downloadedsize >= targetsize:
-                if not downloadedpercent == 100:
+                if show_progress and not downloadedpercent == 100:
                     munkicommon.display_percent_done(100, 100)
                 os.rename(tempdownloadpath, destinationpath)
                 if (resume and not header.get('etag')
@@ -414,7 +427,8 @@ def getResourceIfChangedAtomically(url,
                                    message=None,
                                    resume=False,
                                    verify=False,
-                                   follow_redirects=False):
+                                   follow_redirects=False,
+                                   show_progress=True):
     """Gets file from a URL.
        Checks first if there is already a file with the necessary checksum.
        Then checks if the file has changed on the server, resuming or
@@ -455,7 +469,8 @@ def getResourceIfChangedAtomically(url,
         changed = getHTTPfileIfChangedAtomically(
             url, destinationpath,
             cert_info=cert_info, custom_headers=custom_headers,
-            message=message, resume=resume, follow_redirects=follow_redirects)
+            message=message, resume=resume, follow_redirects=follow_redirects,
+            show_progress=show_progress)
     elif url_parse.scheme == 'file':
         changed = getFileIfChangedAtomically(url_parse.path, destinationpath)
     else:
@@ -535,7 +550,8 @@ def getFileIfChangedAtomically(path, destinationpath):
 def getHTTPfileIfChangedAtomically(url, destinationpath,
                                    cert_info=None, custom_headers=None,
                                    message=None, resume=False,
-                                   follow_redirects=False):
+                                   follow_redirects=False,
+                                   show_progress=True):
     """Gets file from HTTP URL, checking first to see if it has changed on the
        server.
 
@@ -562,7 +578,8 @@ def getHTTPfileIfChangedAtomically(url, destinationpath,
                       message=message,
                       onlyifnewer=getonlyifnewer,
                       resume=resume,
-                      follow_redirects=follow_redirects)
+                      follow_redirects=follow_redirects,
+                      show_progress=show_progress)
 
     except CurlError, err:
         err = 'Error %s: %s' % tuple(err)
@@ -1085,7 +1085,8 @@ def removeItemFromSelfServeUninstallList(itemname):
                 [item for item in plist.get('managed_uninstalls', [])
                  if item != itemname]
             try:
-                FoundationPlist.writePlist(plist, selfservemanifest)
+                FoundationPlist.writePlist(plist, selfservemanifest,
+                                           binary=True)
             except FoundationPlist.FoundationPlistException:
                 pass
 
@@ -1205,7 +1206,8 @@ def run(only_unattended=False):
             # need to write the installinfo back out minus the stuff we
             # actually installed
             try:
-                FoundationPlist.writePlist(installinfo, installinfopath)
+                FoundationPlist.writePlist(installinfo, installinfopath,
+                                           binary=True)
             except FoundationPlist.NSPropertyListWriteException:
                 # not fatal
                 munkicommon.display_warning(
@@ -374,7 +374,13 @@ def display_debug1(msg, *args):
     """
     Displays debug messages, formatting as needed
     for verbose/non-verbose and munkistatus-style output.
+    Message formatting is skipped entirely if the message would be
+    neither displayed nor logged, so pass format args rather than
+    pre-formatting the message.
     """
+    if ((munkistatusoutput or verbose <= 2) and
+            pref('LoggingLevel') <= 1):
+        return
     msg = concat_log_message(msg, *args)
     if munkistatusoutput:
         pass
@@ -389,7 +395,12 @@ def display_debug2(msg, *args):
     """
     Displays debug messages, formatting as needed
     for verbose/non-verbose and munkistatus-style output.
+    Message formatting is skipped entirely if the message would be
+    neither displayed nor logged.
     """
+    if ((munkistatusoutput or verbose <= 3) and
+            pref('LoggingLevel') <= 2):
+        return
     msg = concat_log_message(msg, *args)
     if munkistatusoutput:
         pass
@@ -24,11 +24,15 @@ Created by Greg Neagle on 2008-11-13.
 # import calendar
 # import errno
 import datetime
+import itertools
 import os
-# import re
+import Queue
+import re
 # import shutil
 import subprocess
 import socket
+import sys
+import threading
 # import time
 import urllib2
 import urlparse
@@ -43,18 +47,38 @@ import appleupdates
 import FoundationPlist
 
 # Apple's libs
-from Foundation import NSDate, NSPredicate
+from Foundation import NSAutoreleasePool, NSDate, NSPredicate, NSTimeZone
 
 
 # This many hours before a force install deadline, start notifying the user.
 FORCE_INSTALL_WARNING_HOURS = 4
 
+# RestartAction values that mean an item needs a restart
+RESTART_ACTIONS = ('RequireRestart', 'RecommendRestart')
+
+
+# preferences don't change during a run, so we cache the values we look up
+# over and over; cleared at the start of each check()
+PREFS = {}
+
+
+def cachedPref(pref_name):
+    """Returns munkicommon.pref(pref_name), reading it only once per run."""
+    if not pref_name in PREFS:
+        PREFS[pref_name] = munkicommon.pref(pref_name)
+    return PREFS[pref_name]
+
+
+# pkginfo keys whose values should be lists of strings
+LIST_OF_STRINGS_KEYS = ('requires', 'update_for', 'supported_architectures')
+
 
 def makeCatalogDB(catalogitems):
     """Takes an array of catalog items and builds some indexes so we can
     get our common data faster. Returns a dict we can use like a database"""
     name_table = {}
     pkgid_table = {}
+    required_by_table = {}
 
     itemindex = -1
     for item in catalogitems:
@@ -68,6 +92,13 @@ def makeCatalogDB(catalogitems):
         # normalize the version number
         vers = trimVersionString(vers)
 
+        # fix possible admin errors where a list-of-strings key is a
+        # string instead of a list of strings, so everything else
+        # can rely on getting a list
+        for key in LIST_OF_STRINGS_KEYS:
+            if isinstance(item.get(key), basestring):
+                item[key] = [item[key]]
+
         # build indexes for items by name and version
         if not name in name_table:
             name_table[name] = {}
@@ -75,6 +106,12 @@ def makeCatalogDB(catalogitems):
             name_table[name][vers] = []
         name_table[name][vers].append(itemindex)
 
+        # build reverse index of items by the items they require
+        for requirement in item.get('requires', []):
+            if not requirement in required_by_table:
+                required_by_table[requirement] = []
+            required_by_table[requirement].append(itemindex)
+
         # build table of receipts
         if 'receipts' in item:
             for receipt in item['receipts']:
@@ -89,18 +126,21 @@ def makeCatalogDB(catalogitems):
                         receipt['packageid']][
                             receipt['version']].append(itemindex)
 
+    # build table of item indexes for each name, ordered newest version
+    # first, so lookups for the latest version don't need to sort
+    latest_table = {}
+    for name, versions in name_table.iteritems():
+        versionlist = versions.keys()
+        versionlist.sort(key=munkicommon.MunkiLooseVersion, reverse=True)
+        latest_table[name] = []
+        for vers in versionlist:
+            latest_table[name].extend(versions[vers])
+
     # build table of update items with a list comprehension --
     # filter all items from the catalogitems that have a non-empty
     # 'update_for' list
     updaters = [item for item in catalogitems if item.get('update_for')]
 
-    # now fix possible admin errors where 'update_for' is a string instead
-    # of a list of strings
-    for update in updaters:
-        if isinstance(update['update_for'], basestring):
-            # convert to list of strings
-            update['update_for'] = [update['update_for']]
-
     # build table of autoremove items with a list comprehension --
     # filter all items from the catalogitems that have a non-empty
     # 'autoremove' list
@@ -114,7 +154,9 @@ def makeCatalogDB(catalogitems):
 
     pkgdb = {}
     pkgdb['named'] = name_table
+    pkgdb['latest'] = latest_table
     pkgdb['receipts'] = pkgid_table
+    pkgdb['required_by'] = required_by_table
     pkgdb['updaters'] = updaters
     pkgdb['autoremoveitems'] = autoremoveitems
     pkgdb['items'] = catalogitems
@@ -122,6 +164,66 @@ def makeCatalogDB(catalogitems):
     return pkgdb
 
 
+# version of the catalog DB layout built by makeCatalogDB; bump this
+# whenever makeCatalogDB changes, so saved DBs get rebuilt
+CATALOG_DB_VERSION = 1
+
+
+def getCatalogDBDir():
+    """Returns the path to the directory of our saved catalog DBs"""
+    return os.path.join(cachedPref('ManagedInstallDir'), 'catalogdbs')
+
+
+def loadCatalogDB(catalogpath, catalogchanged=True):
+    """Returns a catalog DB (as built by makeCatalogDB) for the catalog
+    at catalogpath.
+
+    Building the DB means parsing the entire catalog, so we save a binary
+    copy of each DB, and reuse it on later runs as long as the catalog
+    hasn't been re-downloaded and its modtime and size, and
+    CATALOG_DB_VERSION, are unchanged.
+
+    Raises FoundationPlist.NSPropertyListSerializationException if the
+    catalog is invalid.
+    """
+    dbdir = getCatalogDBDir()
+    dbpath = os.path.join(dbdir, os.path.basename(catalogpath))
+    catalogstat = os.stat(catalogpath)
+    signature = '%s:%s:%s' % (CATALOG_DB_VERSION,
+                              int(catalogstat.st_mtime), catalogstat.st_size)
+
+    if not catalogchanged and os.path.exists(dbpath):
+        try:
+            pkgdb = FoundationPlist.readPlist(dbpath)
+        except FoundationPlist.NSPropertyListSerializationException:
+            pkgdb = {}
+        if pkgdb.get('signature') == signature:
+            munkicommon.display_debug1(
+                'Using saved catalog DB for %s', catalogpath)
+            # updaters aren't saved, so they stay the same objects
+            # as the ones in items
+            pkgdb['updaters'] = [item for item in pkgdb['items']
+                                 if item.get('update_for')]
+            return pkgdb
+
+    catalogdata = FoundationPlist.readPlist(catalogpath)
+    pkgdb = makeCatalogDB(catalogdata)
+
+    saveddb = dict(pkgdb)
+    del saveddb['updaters']
+    saveddb['signature'] = signature
+    try:
+        if not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        FoundationPlist.writePlist(saveddb, dbpath, binary=True)
+    except (OSError, FoundationPlist.FoundationPlistException), err:
+        # not fatal; we'll just have to parse the catalog again next time
+        munkicommon.display_debug1(
+            'Could not save catalog DB for %s: %s', catalogpath, err)
+
+    return pkgdb
+
+
 def addPackageids(catalogitems, pkgid_table):
     """Adds packageids from each catalogitem to a dictionary"""
     for item in catalogitems:
@@ -247,8 +349,8 @@ def analyzeInstalledPkgs():
     for name in installed:
         for pkg in installedpkgsmatchedtoname[name]:
             if not pkg in references:
-                references[pkg] = []
-            references[pkg].append(name)
+                references[pkg] = set()
+            references[pkg].add(name)
 
     PKGDATA['receipts_for_name'] = installedpkgsmatchedtoname
     PKGDATA['installed_names'] = installed
@@ -682,8 +784,8 @@ def download_installeritem(item_pl, installinfo, uninstalling=False):
     # allow pkginfo preferences to override system munki preferences
     downloadbaseurl = item_pl.get('PackageCompleteURL') or \
         item_pl.get('PackageURL') or \
-        munkicommon.pref('PackageURL') or \
-        munkicommon.pref('SoftwareRepoURL') + '/pkgs/'
+        cachedPref('PackageURL') or \
+        cachedPref('SoftwareRepoURL') + '/pkgs/'
 
     # build a URL, quoting the the location to encode reserved characters
     if item_pl.get('PackageCompleteURL'):
@@ -698,7 +800,7 @@ def download_installeritem(item_pl, installinfo, uninstalling=False):
     munkicommon.display_debug2('Package name is: %s' % pkgname)
     munkicommon.display_debug2('Download URL is: %s' % pkgurl)
 
-    ManagedInstallDir = munkicommon.pref('ManagedInstallDir')
+    ManagedInstallDir = cachedPref('ManagedInstallDir')
     mycachedir = os.path.join(ManagedInstallDir, 'Cache')
     destinationpath = getDownloadCachePath(mycachedir, location)
     munkicommon.display_debug2('Downloading to: %s' % destinationpath)
@@ -753,6 +855,10 @@ def isItemInInstallInfo(manifestitem_pl, thelist, vers=''):
     return False
 
 
+# cache of nameAndVersion results
+NAME_AND_VERSION_CACHE = {}
+
+
 def nameAndVersion(aString):
     """Splits a string into the name and version number.
 
@@ -762,15 +868,21 @@ def nameAndVersion(aString):
     'AdobePhotoshopCS3--11.2.1' becomes ('AdobePhotoshopCS3', '11.2.1')
     'MicrosoftOffice2008-12.2.1' becomes ('MicrosoftOffice2008', '12.2.1')
     """
+    if aString in NAME_AND_VERSION_CACHE:
+        return NAME_AND_VERSION_CACHE[aString]
+
+    result = (aString, '')
     for delim in ('--', '-'):
         if aString.count(delim) > 0:
             chunks = aString.split(delim)
             vers = chunks.pop()
             name = delim.join(chunks)
             if vers[0] in '0123456789':
-                return (name, vers)
+                result = (name, vers)
+                break
 
-    return (aString, '')
+    NAME_AND_VERSION_CACHE[aString] = result
+    return result
 
 
 def getAllItemsWithName(name, cataloglist):
@@ -789,7 +901,7 @@ def getAllItemsWithName(name, cataloglist):
     # we'll throw away any included version info
     name = nameAndVersion(name)[0]
 
-    munkicommon.display_debug1('Looking for all items matching: %s...' % name)
+    munkicommon.display_debug1('Looking for all items matching: %s...', name)
     for catalogname in cataloglist:
         if not catalogname in CATALOG.keys():
             # in case catalogname refers to a non-existent catalog...
@@ -797,15 +909,16 @@ def getAllItemsWithName(name, cataloglist):
         # is name in the catalog name table?
         if name in CATALOG[catalogname]['named']:
             versionsmatchingname = CATALOG[catalogname]['named'][name]
+            items_by_index = CATALOG[catalogname]['items']
             for vers in versionsmatchingname.keys():
                 if vers != 'latest':
-                    indexlist = CATALOG[catalogname]['named'][name][vers]
+                    indexlist = versionsmatchingname[vers]
                     for index in indexlist:
-                        thisitem = CATALOG[catalogname]['items'][index]
+                        thisitem = items_by_index[index]
                         if not thisitem in itemlist:
                             munkicommon.display_debug1(
-                                'Adding item %s, version %s from catalog %s...' %
-                                (name, thisitem['version'], catalogname))
+                                'Adding item %s, version %s from catalog %s...',
+                                name, thisitem['version'], catalogname)
                             itemlist.append(thisitem)
 
     if itemlist:
@@ -814,6 +927,10 @@ def getAllItemsWithName(name, cataloglist):
     return itemlist
 
 
+# matches all lone trailing zeros at the end of a version string
+TRAILING_ZEROS = re.compile(r'(\.0)+$')
+
+
 def trimVersionString(version_string):
     """Trims all lone trailing zeros in the version string after major/minor.
 
@@ -825,11 +942,16 @@ def trimVersionString(version_string):
     """
     if version_string == None or version_string == '':
         return ''
-    version_parts = version_string.split('.')
-    # strip off all trailing 0's in the version, while over 2 parts.
-    while len(version_parts) > 2 and version_parts[-1] == '0':
-        del (version_parts[-1])
-    return '.'.join(version_parts)
+    version_parts = version_string.split('.', 2)
+    if len(version_parts) < 3:
+        return version_string
+    # strip off all trailing 0's in the version after major/minor.
+    return '%s.%s%s' % (version_parts[0], version_parts[1],
+                        TRAILING_ZEROS.sub('', '.' + version_parts[2]))
+
+
+# cache of getItemDetail results; cleared whenever CATALOG changes
+ITEM_DETAIL_CACHE = {}
 
 
 def getItemDetail(name, cataloglist, vers=''):
@@ -839,12 +961,18 @@ def getItemDetail(name, cataloglist, vers=''):
     ('TextWrangler--2.3.0.0.0') that version is used.
     If no version is given at all, the latest version is assumed.
     Returns a pkginfo item.
+
+    Results are cached, since the same item is often looked up many times
+    while processing dependencies and updates.
     """
-    def compare_version_keys(a, b):
-        """Internal comparison function for use in sorting"""
-        return cmp(munkicommon.MunkiLooseVersion(b),
-                   munkicommon.MunkiLooseVersion(a))
+    key = (name, tuple(cataloglist), vers)
+    if key not in ITEM_DETAIL_CACHE:
+        ITEM_DETAIL_CACHE[key] = findItemDetail(name, cataloglist, vers)
+    return ITEM_DETAIL_CACHE[key]
+
 
+def findItemDetail(name, cataloglist, vers=''):
+    """Does the actual catalog search for getItemDetail."""
     (name, includedversion) = nameAndVersion(name)
     if vers == '':
         if includedversion:
@@ -854,8 +982,8 @@ def getItemDetail(name, cataloglist, vers=''):
     else:
         vers = 'latest'
 
-    munkicommon.display_debug1('Looking for detail for: %s, version %s...' %
-                               (name, vers))
+    munkicommon.display_debug1('Looking for detail for: %s, version %s...',
+                               name, vers)
     rejected_items = []
     for catalogname in cataloglist:
         if not catalogname in CATALOG.keys():
@@ -867,30 +995,28 @@ def getItemDetail(name, cataloglist, vers=''):
             itemsmatchingname = CATALOG[catalogname]['named'][name]
             indexlist = []
             if vers == 'latest':
-                # order all our items, latest first
-                versionlist = itemsmatchingname.keys()
-                versionlist.sort(compare_version_keys)
-                for versionkey in versionlist:
-                    indexlist.extend(itemsmatchingname[versionkey])
+                # all our items, already ordered latest first
+                indexlist = CATALOG[catalogname]['latest'][name]
 
             elif vers in itemsmatchingname:
                 # get the specific requested version
                 indexlist = itemsmatchingname[vers]
 
             munkicommon.display_debug1(
-                'Considering %s items with name %s from catalog %s' %
-                (len(indexlist), name, catalogname))
+                'Considering %s items with name %s from catalog %s',
+                len(indexlist), name, catalogname)
+            items_by_index = CATALOG[catalogname]['items']
             for index in indexlist:
-                item = CATALOG[catalogname]['items'][index]
+                item = items_by_index[index]
                 # we have an item whose name and version matches the request.
                 # now check to see if it meets os and cpu requirements
                 if item.get('minimum_os_version', ''):
                     min_os_vers = item['minimum_os_version']
                     munkicommon.display_debug1(
-                        'Considering item %s, ' % item['name'] +
-                        'version %s ' % item['version'] +
-                        'with minimum os version required %s' % min_os_vers)
-                    munkicommon.display_debug1('Our OS version is %s' %
+                        'Considering item %s, version %s '
+                        'with minimum os version required %s',
+                        item['name'], item['version'], min_os_vers)
+                    munkicommon.display_debug1('Our OS version is %s',
                                                MACHINE['os_vers'])
                     if (munkicommon.MunkiLooseVersion(MACHINE['os_vers']) <
                        munkicommon.MunkiLooseVersion(min_os_vers)):
@@ -907,10 +1033,10 @@ def getItemDetail(name, cataloglist, vers=''):
                 if item.get('maximum_os_version', ''):
                     max_os_vers = item['maximum_os_version']
                     munkicommon.display_debug1(
-                        'Considering item %s, ' % item['name'] +
-                        'version %s ' % item['version'] +
-                        'with maximum os version supported %s' % max_os_vers)
-                    munkicommon.display_debug1('Our OS version is %s' %
+                        'Considering item %s, version %s '
+                        'with maximum os version supported %s',
+                        item['name'], item['version'], max_os_vers)
+                    munkicommon.display_debug1('Our OS version is %s',
                                                MACHINE['os_vers'])
                     if (munkicommon.MunkiLooseVersion(MACHINE['os_vers']) >
                             munkicommon.MunkiLooseVersion(max_os_vers)):
@@ -927,11 +1053,11 @@ def getItemDetail(name, cataloglist, vers=''):
                 if 'supported_architectures' in item:
                     supported_arch_found = False
                     munkicommon.display_debug1(
-                        'Considering item %s, ' % item['name'] +
-                        'version %s ' % item['version'] +
-                        'with supported architectures: %s' %
+                        'Considering item %s, version %s '
+                        'with supported architectures: %s',
+                        item['name'], item['version'],
                         item['supported_architectures'])
-                    munkicommon.display_debug1('Our architecture is %s' %
+                    munkicommon.display_debug1('Our architecture is %s',
                                                MACHINE['arch'])
                     for arch in item['supported_architectures']:
                         if arch == MACHINE['arch']:
@@ -955,8 +1081,8 @@ def getItemDetail(name, cataloglist, vers=''):
                 # item name, version, minimum_os_version, and
                 # supported_architecture are all OK
                 munkicommon.display_debug1(
-                    'Found %s, version %s in catalog %s' %
-                    (item['name'], item['version'], catalogname))
+                    'Found %s, version %s in catalog %s',
+                    item['name'], item['version'], catalogname)
                 return item
 
     # if we got this far, we didn't find it.
@@ -978,7 +1104,7 @@ def enoughDiskSpace(manifestitem_pl, installlist=None,
     installedsize = 0
     alreadydownloadedsize = 0
     if 'installer_item_location' in manifestitem_pl:
-        cachedir = os.path.join(munkicommon.pref('ManagedInstallDir'), 'Cache')
+        cachedir = os.path.join(cachedPref('ManagedInstallDir'), 'Cache')
         download = getDownloadCachePath(
             cachedir,
             manifestitem_pl['installer_item_location'])
@@ -1055,35 +1181,35 @@ def installedState(item_pl):
     # does 'installs' exist and is it non-empty?
     if item_pl.get('installs', None):
         installitems = item_pl['installs']
-        for item in installitems:
-            try:
+        try:
+            for item in installitems:
                 comparison = compareItemVersion(item)
                 if comparison in (-1, 0):
                     return 0
                 elif comparison == 2:
                     # this item is newer
                     foundnewer = True
-            except munkicommon.Error, errmsg:
-                # some problem with the installs data
-                munkicommon.display_error(errmsg)
-                return 0
+        except munkicommon.Error, errmsg:
+            # some problem with the installs data
+            munkicommon.display_error(errmsg)
+            return 0
 
     # if there is no 'installs' key, then we'll use receipt info
     # to determine install status.
     elif 'receipts' in item_pl:
         receipts = item_pl['receipts']
-        for item in receipts:
-            try:
+        try:
+            for item in receipts:
                 comparison = compareReceiptVersion(item)
                 if comparison in (-1, 0):
                     # not there or older
                     return 0
                 elif comparison == 2:
                     foundnewer = True
-            except munkicommon.Error, errmsg:
-                # some problem with the receipts data
-                munkicommon.display_error(errmsg)
-                return 0
+        except munkicommon.Error, errmsg:
+            # some problem with the receipts data
+            munkicommon.display_error(errmsg)
+            return 0
 
     # if we got this far, we passed all the tests, so the item
     # must be installed (or we don't have enough info...)
@@ -1103,29 +1229,29 @@ def someVersionInstalled(item_pl):
     if item_pl.get('installs'):
         installitems = item_pl['installs']
         # check each item for existence
-        for item in installitems:
-            try:
+        try:
+            for item in installitems:
                 if compareItemVersion(item) == 0:
                     # not there
                     return False
-            except munkicommon.Error, errmsg:
-                # some problem with the installs data
-                munkicommon.display_error(errmsg)
-                return False
+        except munkicommon.Error, errmsg:
+            # some problem with the installs data
+            munkicommon.display_error(errmsg)
+            return False
 
     # if there is no 'installs' key, then we'll use receipt info
     # to determine install status.
     elif 'receipts' in item_pl:
         receipts = item_pl['receipts']
-        for item in receipts:
-            try:
+        try:
+            for item in receipts:
                 if compareReceiptVersion(item) == 0:
                     # not there
                     return False
-            except munkicommon.Error, errmsg:
-                # some problem with the installs data
-                munkicommon.display_error(errmsg)
-                return False
+        except munkicommon.Error, errmsg:
+            # some problem with the receipts data
+            munkicommon.display_error(errmsg)
+            return False
 
     # if we got this far, we passed all the tests, so the item
     # must be installed (or we don't have enough info...)
@@ -1173,19 +1299,27 @@ def getAutoRemovalItems(installinfo, cataloglist):
     Then filters against the removals list, which contains all the removals
     that have already been processed.
     """
+    # names we should skip: anything already processed for install or
+    # removal, and (as we go) anything we've already added
+    skipnames = installinfo['_processed_install_names'].union(
+        installinfo['processed_uninstalls'])
+
     autoremovalnames = []
     for catalogname in (cataloglist or []):
-        if catalogname in CATALOG.keys():
-            autoremovalnames += CATALOG[catalogname]['autoremoveitems']
-
-    processed_installs_names = [nameAndVersion(item)[0]
-                                for item in installinfo['processed_installs']]
-    autoremovalnames = [item for item in autoremovalnames
-                        if item not in processed_installs_names
-                        and item not in installinfo['processed_uninstalls']]
+        if catalogname in CATALOG:
+            for name in CATALOG[catalogname]['autoremoveitems']:
+                if name not in skipnames:
+                    skipnames.add(name)
+                    autoremovalnames.append(name)
     return autoremovalnames
 
 
+# caches of lookForUpdates/lookForUpdatesForVersion results;
+# cleared whenever CATALOG changes
+UPDATES_CACHE = {}
+VERSION_UPDATES_CACHE = {}
+
+
 def lookForUpdates(itemname, cataloglist):
     """Looks for updates for a given manifest item that is either
     installed or scheduled to be installed or removed. This handles not only
@@ -1196,33 +1330,39 @@ def lookForUpdates(itemname, cataloglist):
     Returns a list of manifestitem names that are updates for
     manifestitem.
     """
+    key = (itemname, tuple(cataloglist))
+    if key not in UPDATES_CACHE:
+        UPDATES_CACHE[key] = findUpdates(itemname, cataloglist)
+    # return a copy, since callers may extend the list
+    return list(UPDATES_CACHE[key])
+
 
+def findUpdates(itemname, cataloglist):
+    """Does the actual catalog search for lookForUpdates."""
     munkicommon.display_debug1('Looking for updates for: %s', itemname)
-    # get a list of catalog items that are updates for other items
+    # get a list of catalog items that are updates for other items,
+    # keeping only the first occurence of each name
     update_list = []
+    seen = set()
     for catalogname in cataloglist:
-        if not catalogname in CATALOG.keys():
+        if not catalogname in CATALOG:
             # in case the list refers to a non-existant catalog
             continue
 
-        updaters = CATALOG[catalogname]['updaters']
-        # list comprehension coming up...
-        update_items = [catalogitem['name']
-                        for catalogitem in updaters
-                        if (itemname in catalogitem.get('update_for', []))]
-        if update_items:
-            update_list.extend(update_items)
-
-    # make sure the list has only unique items:
-    update_list = list(set(update_list))
+        for catalogitem in CATALOG[catalogname]['updaters']:
+            if itemname in catalogitem['update_for']:
+                updatename = catalogitem['name']
+                if updatename not in seen:
+                    seen.add(updatename)
+                    update_list.append(updatename)
 
     if update_list:
         # updates were found, so let's display them
         num_updates = len(update_list)
         # format the update list for better on-screen viewing
         update_list_display = ", ".join(str(x) for x in update_list)
-        munkicommon.display_debug1('Found %s update(s): %s' % (
-            num_updates, update_list_display))
+        munkicommon.display_debug1('Found %s update(s): %s',
+                                   num_updates, update_list_display)
 
     return update_list
 
@@ -1231,40 +1371,67 @@ def lookForUpdatesForVersion(itemname, itemversion, cataloglist):
     """Looks for updates for a specific version of an item. Since these
     can appear in manifests and pkginfo as item-version or item--version
     we have to search twice."""
+    key = (itemname, itemversion, tuple(cataloglist))
+    if key in VERSION_UPDATES_CACHE:
+        return list(VERSION_UPDATES_CACHE[key])
 
     name_and_version = '%s-%s' % (itemname, itemversion)
     alt_name_and_version = '%s--%s' % (itemname, itemversion)
     update_list = lookForUpdates(name_and_version, cataloglist)
-    update_list.extend(lookForUpdates(alt_name_and_version, cataloglist))
 
     # make sure the list has only unique items:
-    update_list = list(set(update_list))
+    seen = set(update_list)
+    for update_item in lookForUpdates(alt_name_and_version, cataloglist):
+        if update_item not in seen:
+            seen.add(update_item)
+            update_list.append(update_item)
 
+    VERSION_UPDATES_CACHE[key] = list(update_list)
     return update_list
 
 
+def uniqueItems(items):
+    """Yields the items from an iterable, skipping any we've already seen.
+    Used to merge update lists that often name the same item more than
+    once."""
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def processedAs(manifestitemname, installinfo, check_updates=True):
+    """Determines if a manifest item has already been processed.
+
+    Returns 'update', 'install' or 'uninstall' if the item has already
+    been processed as that kind of item, or None if it hasn't. Managed
+    updates are only considered if check_updates is True.
+    """
+    if check_updates and manifestitemname in installinfo['_managed_updates']:
+        return 'update'
+    if manifestitemname in installinfo['_processed_installs']:
+        return 'install'
+    if manifestitemname in installinfo['_processed_uninstalls']:
+        return 'uninstall'
+    return None
+
+
 def processManagedUpdate(manifestitem, cataloglist, installinfo):
     """Process a managed_updates item to see if it is installed, and if so,
     if it needs an update.
     """
     manifestitemname = os.path.split(manifestitem)[1]
     munkicommon.display_debug1(
-        '* Processing manifest item %s for update' % manifestitemname)
+        '* Processing manifest item %s for update', manifestitemname)
 
-    # check to see if item is already in the update list:
-    if manifestitemname in installinfo['managed_updates']:
+    # check to see if item is already in the update, install
+    # or removal lists:
+    processed_as = processedAs(manifestitemname, installinfo)
+    if processed_as:
         munkicommon.display_debug1(
-            '%s has already been processed for update.' % manifestitemname)
-        return
-    # check to see if item is already in the installlist:
-    if manifestitemname in installinfo['processed_installs']:
-        munkicommon.display_debug1(
-            '%s has already been processed for install.' % manifestitemname)
-        return
-    # check to see if item is already in the removallist:
-    if manifestitemname in installinfo['processed_uninstalls']:
-        munkicommon.display_debug1(
-            '%s has already been processed for uninstall.' % manifestitemname)
+            '%s has already been processed for %s.',
+            manifestitemname, processed_as)
         return
 
     item_pl = getItemDetail(manifestitem, cataloglist)
@@ -1281,11 +1448,12 @@ def processManagedUpdate(manifestitem, cataloglist, installinfo):
     if someVersionInstalled(item_pl):
         # add to the list of processed managed_updates
         installinfo['managed_updates'].append(manifestitemname)
+        installinfo['_managed_updates'].add(manifestitemname)
         unused_result = processInstall(manifestitem, cataloglist, installinfo)
     else:
         munkicommon.display_debug1(
-            '%s does not appear to be installed, so no managed updates...'
-            % manifestitemname)
+            '%s does not appear to be installed, so no managed updates...',
+            manifestitemname)
 
 
 def processOptionalInstall(manifestitem, cataloglist, installinfo):
@@ -1294,33 +1462,25 @@ def processOptionalInstall(manifestitem, cataloglist, installinfo):
     """
     manifestitemname = os.path.split(manifestitem)[1]
     munkicommon.display_debug1(
-        "* Processing manifest item %s for optional install" %
+        "* Processing manifest item %s for optional install",
         manifestitemname)
 
     # have we already processed this?
-    if manifestitemname in installinfo['optional_installs']:
+    processed_as = processedAs(manifestitemname, installinfo,
+                               check_updates=False)
+    if processed_as:
         munkicommon.display_debug1(
-            '%s has already been processed for optional install.' %
-            manifestitemname)
-        return
-    elif manifestitemname in installinfo['processed_installs']:
-        munkicommon.display_debug1(
-            '%s has already been processed for install.' %
-            manifestitemname)
-        return
-    elif manifestitemname in installinfo['processed_uninstalls']:
-        munkicommon.display_debug1(
-            '%s has already been processed for uninstall.' % manifestitemname)
+            '%s has already been processed for %s.',
+            manifestitemname, processed_as)
         return
 
     # check to see if item (any version) is already in the
     # optional_install list:
-    for item in installinfo['optional_installs']:
-        if manifestitemname == item['name']:
-            munkicommon.display_debug1(
-                '%s has already been processed for optional install.' %
-                manifestitemname)
-            return
+    if manifestitemname in installinfo['_optional_installs_names']:
+        munkicommon.display_debug1(
+            '%s has already been processed for optional install.',
+            manifestitemname)
+        return
 
     item_pl = getItemDetail(manifestitem, cataloglist)
     if not item_pl:
@@ -1333,6 +1493,7 @@ def processOptionalInstall(manifestitem, cataloglist, installinfo):
 
     # if we get to this point we can add this item
     # to the list of optional installs
+    installer_item_size = item_pl.get('installer_item_size', 0)
     iteminfo = {}
     iteminfo['name'] = item_pl.get('name', manifestitemname)
     iteminfo['description'] = item_pl.get('description', '')
@@ -1343,10 +1504,9 @@ def processOptionalInstall(manifestitem, cataloglist, installinfo):
         iteminfo['needs_update'] = (installedState(item_pl) == 0)
     iteminfo['uninstallable'] = item_pl.get('uninstallable', False)
     if (not iteminfo['installed']) or (iteminfo.get('needs_update')):
-        iteminfo['installer_item_size'] = \
-            item_pl.get('installer_item_size', 0)
-        iteminfo['installed_size'] = item_pl.get('installer_item_size',
-                                                 iteminfo['installer_item_size'])
+        iteminfo['installer_item_size'] = installer_item_size
+        iteminfo['installed_size'] = item_pl.get('installed_size',
+                                                 installer_item_size)
         if not enoughDiskSpace(item_pl,
                                installinfo.get('managed_installs', []),
                                warn=False):
@@ -1354,8 +1514,30 @@ def processOptionalInstall(manifestitem, cataloglist, installinfo):
                 'Insufficient disk space to download and install.'
 
     munkicommon.display_debug1(
-        "Adding %s to the optional install list" % iteminfo['name'])
+        "Adding %s to the optional install list", iteminfo['name'])
     installinfo['optional_installs'].append(iteminfo)
+    installinfo['_optional_installs_names'].add(iteminfo['name'])
+
+
+# pkginfo keys copied to managed_installs items if they exist
+OPTIONAL_INSTALL_KEYS = frozenset([
+    'suppress_bundle_relocation',
+    'installer_choices_xml',
+    'installer_environment',
+    'adobe_install_info',
+    'RestartAction',
+    'installer_type',
+    'adobe_package_name',
+    'package_path',
+    'blocking_applications',
+    'installs',
+    'requires',
+    'update_for',
+    'preinstall_script',
+    'postinstall_script',
+    'items_to_copy',  # used w/ copy_from_dmg
+    'copy_local',     # used w/ AdobeCS5 Updaters
+    'force_install_after_date'])
 
 
 def processInstall(manifestitem, cataloglist, installinfo):
@@ -1375,17 +1557,17 @@ def processInstall(manifestitem, cataloglist, installinfo):
 
     manifestitemname = os.path.split(manifestitem)[1]
     munkicommon.display_debug1(
-        '* Processing manifest item %s for install' % manifestitemname)
+        '* Processing manifest item %s for install', manifestitemname)
     (manifestitemname_withoutversion, includedversion) = nameAndVersion(
         manifestitemname)
     # have we processed this already?
-    if manifestitemname in installinfo['processed_installs']:
+    if manifestitemname in installinfo['_processed_installs']:
         munkicommon.display_debug1(
-            '%s has already been processed for install.' %
+            '%s has already been processed for install.',
             manifestitemname)
         return True
     elif (manifestitemname_withoutversion in
-          installinfo['processed_uninstalls']):
+          installinfo['_processed_uninstalls']):
         munkicommon.display_warning(
             ('Will not process %s for install because it has already '
              'been processed for uninstall!') % manifestitemname)
@@ -1399,7 +1581,7 @@ def processInstall(manifestitem, cataloglist, installinfo):
             'No pkginfo for %s found in catalogs: %s' %
             (manifestitem, ', '.join(cataloglist)))
         return False
-    elif manifestitemname in installinfo['managed_updates']:
+    elif manifestitemname in installinfo['_managed_updates']:
         # we're processing this as a managed update, so don't
         # add it to the processed_installs list
         pass
@@ -1407,12 +1589,19 @@ def processInstall(manifestitem, cataloglist, installinfo):
         # we found it, so add it to our list of procssed installs
         # so we don't process it again in the future
         installinfo['processed_installs'].append(manifestitemname)
+        installinfo['_processed_installs'].add(manifestitemname)
+        installinfo['_processed_install_names'].add(
+            manifestitemname_withoutversion)
+
+    item_name = item_pl.get('name', '')
+    item_version = item_pl.get('version', '')
+    installer_item_size = item_pl.get('installer_item_size', 0)
 
     if isItemInInstallInfo(item_pl, installinfo['managed_installs'],
-                           vers=item_pl.get('version')):
+                           vers=item_version):
         # has this item already been added to the list of things to install?
         munkicommon.display_debug1(
-            '%s is or will be installed.' % manifestitemname)
+            '%s is or will be installed.', manifestitemname)
         return True
 
     # check dependencies
@@ -1437,16 +1626,13 @@ def processInstall(manifestitem, cataloglist, installinfo):
     #  When removing an item, any updates for that item are removed as well.
 
     if 'requires' in item_pl:
+        # makeCatalogDB has already made sure this is a list
         dependencies = item_pl['requires']
-        # fix things if 'requires' was specified as a string
-        # instead of an array of strings
-        if isinstance(dependencies, basestring):
-            dependencies = [dependencies]
         for item in dependencies:
             munkicommon.display_detail('%s-%s requires %s. '
                                        'Getting info on %s...' %
-                                       (item_pl.get('name', manifestitemname),
-                                        item_pl.get('version', ''), item, item))
+                                       (item_name or manifestitemname,
+                                        item_version, item, item))
             success = processInstall(item, cataloglist, installinfo)
             if not success:
                 dependenciesMet = False
@@ -1458,17 +1644,16 @@ def processInstall(manifestitem, cataloglist, installinfo):
         return False
 
     iteminfo = {}
-    iteminfo['name'] = item_pl.get('name', '')
-    iteminfo['display_name'] = item_pl.get('display_name', iteminfo['name'])
+    iteminfo['name'] = item_name
+    iteminfo['display_name'] = item_pl.get('display_name', item_name)
     iteminfo['description'] = item_pl.get('description', '')
 
     installed_state = installedState(item_pl)
     if installed_state == 0:
         munkicommon.display_detail('Need to install %s' % manifestitemname)
-        iteminfo['installer_item_size'] = item_pl.get(
-            'installer_item_size', 0)
+        iteminfo['installer_item_size'] = installer_item_size
         iteminfo['installed_size'] = item_pl.get('installed_size',
-                                                 iteminfo['installer_item_size'])
+                                                 installer_item_size)
         try:
             # Get a timestamp, then run download the installer item.
             start = datetime.datetime.now()
@@ -1512,27 +1697,8 @@ def processInstall(manifestitem, cataloglist, installinfo):
                     iteminfo['unattended_install'] = True
 
             # optional keys
-            optional_keys = ['suppress_bundle_relocation',
-                             'installer_choices_xml',
-                             'installer_environment',
-                             'adobe_install_info',
-                             'RestartAction',
-                             'installer_type',
-                             'adobe_package_name',
-                             'package_path',
-                             'blocking_applications',
-                             'installs',
-                             'requires',
-                             'update_for',
-                             'preinstall_script',
-                             'postinstall_script',
-                             'items_to_copy',  # used w/ copy_from_dmg
-                             'copy_local',     # used w/ AdobeCS5 Updaters
-                             'force_install_after_date']
-
-            for key in optional_keys:
-                if key in item_pl:
-                    iteminfo[key] = item_pl[key]
+            for key in OPTIONAL_INSTALL_KEYS.intersection(item_pl):
+                iteminfo[key] = item_pl[key]
 
             installinfo['managed_installs'].append(iteminfo)
 
@@ -1543,21 +1709,25 @@ def processInstall(manifestitem, cataloglist, installinfo):
                 # a specific version was specified in the manifest
                 # so look only for updates for this specific version
                 update_list = lookForUpdatesForVersion(
-                    manifestitemname_withoutversion, includedversion)
+                    manifestitemname_withoutversion, includedversion,
+                    cataloglist)
             else:
                 # didn't specify a specific version, so
                 # now look for all updates for this item
-                update_list = lookForUpdates(manifestitemname_withoutversion,
-                                             cataloglist)
-                # now append any updates specifically
+                # along with any updates specifically
                 # for the version to be installed
-                update_list.extend(
+                update_list = uniqueItems(itertools.chain(
+                    lookForUpdates(manifestitemname_withoutversion,
+                                   cataloglist),
                     lookForUpdatesForVersion(
                         manifestitemname_withoutversion,
                         iteminfo['version_to_install'],
-                        cataloglist))
+                        cataloglist)))
 
             for update_item in update_list:
+                if update_item in installinfo['_processed_installs']:
+                    # already done; don't bother recursing
+                    continue
                 # call processInstall recursively so we get the
                 # latest version and dependencies
                 unused_result = processInstall(update_item,
@@ -1590,7 +1760,7 @@ def processInstall(manifestitem, cataloglist, installinfo):
         iteminfo['installed'] = True
         # record installed size for reporting
         iteminfo['installed_size'] = item_pl.get('installed_size',
-                                                 item_pl.get('installer_item_size', 0))
+                                                 installer_item_size)
         if installed_state == 1:
             # just use the version from the pkginfo
             iteminfo['installed_version'] = item_pl['version']
@@ -1614,9 +1784,10 @@ def processInstall(manifestitem, cataloglist, installinfo):
             # and also any for this specific version
             installed_version = iteminfo['installed_version']
             if not '(or newer)' in installed_version:
-                update_list.extend(
+                update_list = uniqueItems(itertools.chain(
+                    update_list,
                     lookForUpdatesForVersion(
-                        name, installed_version, cataloglist))
+                        name, installed_version, cataloglist)))
         elif compareVersions(
                 includedversion, iteminfo['installed_version']) == 1:
             # manifest specifies a specific version
@@ -1626,6 +1797,9 @@ def processInstall(manifestitem, cataloglist, installinfo):
                 manifestitemname_withoutversion, includedversion, cataloglist)
         # if we have any updates, process them
         for update_item in update_list:
+            if update_item in installinfo['_processed_installs']:
+                # already done; don't bother recursing
+                continue
             # call processInstall recursively so we get updates
             # and any dependencies
             unused_result = processInstall(update_item, cataloglist,
@@ -1641,34 +1815,54 @@ def makePredicateInfoObject():
     '''Builds our info object used for predicate comparisons'''
     if INFO_OBJECT:
         return
-    for key in MACHINE.keys():
-        INFO_OBJECT[key] = MACHINE[key]
-    os_vers = MACHINE['os_vers']
-    os_vers = os_vers + '.0.0'
-    INFO_OBJECT['os_vers_major'] = int(os_vers.split('.')[0])
-    INFO_OBJECT['os_vers_minor'] = int(os_vers.split('.')[1])
-    INFO_OBJECT['os_vers_patch'] = int(os_vers.split('.')[2])
+    INFO_OBJECT.update(MACHINE)
+    (INFO_OBJECT['os_vers_major'],
+     INFO_OBJECT['os_vers_minor'],
+     INFO_OBJECT['os_vers_patch']) = [
+         int(part) for part in (MACHINE['os_vers'] + '.0.0').split('.')[:3]]
     if 'Book' in MACHINE.get('machine_model', ''):
         INFO_OBJECT['machine_type'] = 'laptop'
     else:
         INFO_OBJECT['machine_type'] = 'desktop'
-    for key in CONDITIONS.keys():
-        INFO_OBJECT[key] = CONDITIONS[key]
+    INFO_OBJECT.update(CONDITIONS)
+
+
+# parsed NSPredicates, keyed by predicate string
+PREDICATE_CACHE = {}
+# (catalogs, result) tuples, keyed by predicate string
+PREDICATE_RESULTS = {}
 
 
 def predicateEvaluatesAsTrue(predicate_string):
     '''Evaluates predicate against our info object'''
-    munkicommon.display_debug1('Evaluating predicate: %s' % predicate_string)
-    try:
-        p = NSPredicate.predicateWithFormat_(predicate_string)
-    except Exception, e:
-        munkicommon.display_warning('%s' % e)
-        # can't parse predicate, so return False
-        return False
+    munkicommon.display_debug1('Evaluating predicate: %s', predicate_string)
+    # INFO_OBJECT doesn't change during a run, except for its catalogs
+    # value, so only predicates that refer to catalogs need to be
+    # evaluated again, and then only if the catalogs have changed
+    catalogs = None
+    if 'catalogs' in predicate_string:
+        catalogs = tuple(INFO_OBJECT.get('catalogs') or ())
+    if predicate_string in PREDICATE_RESULTS:
+        cached_catalogs, result = PREDICATE_RESULTS[predicate_string]
+        if cached_catalogs == catalogs:
+            munkicommon.display_debug1(
+                'Predicate %s is %s', predicate_string, result)
+            return result
+
+    p = PREDICATE_CACHE.get(predicate_string)
+    if p is None:
+        try:
+            p = NSPredicate.predicateWithFormat_(predicate_string)
+        except Exception, e:
+            munkicommon.display_warning('%s' % e)
+            # can't parse predicate, so return False
+            return False
+        PREDICATE_CACHE[predicate_string] = p
 
     result = p.evaluateWithObject_(INFO_OBJECT)
+    PREDICATE_RESULTS[predicate_string] = (catalogs, result)
     munkicommon.display_debug1(
-        'Predicate %s is %s' % (predicate_string, result))
+        'Predicate %s is %s', predicate_string, result)
     return result
 
 
@@ -1684,8 +1878,8 @@ def processManifestForKey(manifest, manifest_key, installinfo,
     """
     if isinstance(manifest, basestring):
         munkicommon.display_debug1(
-            "** Processing manifest %s for %s" %
-            (os.path.basename(manifest), manifest_key))
+            "** Processing manifest %s for %s",
+            os.path.basename(manifest), manifest_key)
         manifestdata = getManifestData(manifest)
     else:
         manifestdata = manifest
@@ -1700,6 +1894,9 @@ def processManifestForKey(manifest, manifest_key, installinfo,
     if not cataloglist:
         munkicommon.display_warning('Manifest %s has no catalogs' % manifest)
         return
+    # use a tuple from here on down; our lookup caches are keyed
+    # by tuple(cataloglist), which is then free
+    cataloglist = tuple(cataloglist)
 
     nestedmanifests = manifestdata.get('included_manifests')
     if nestedmanifests:
@@ -1717,7 +1914,7 @@ def processManifestForKey(manifest, manifest_key, installinfo,
     conditionalitems = manifestdata.get('conditional_items')
     if conditionalitems:
         munkicommon.display_debug1(
-            '** Processing conditional_items in %s' % manifest)
+            '** Processing conditional_items in %s', manifest)
         # conditionalitems should be an array of dicts
         # each dict has a predicate; the rest consists of the
         # same keys as a manifest
@@ -1759,6 +1956,30 @@ def getReceiptsToRemove(item):
     return []
 
 
+# pkginfo keys copied to removals items if they exist
+OPTIONAL_UNINSTALL_KEYS = frozenset([
+    'blocking_applications',
+    'installs',
+    'requires',
+    'update_for',
+    'preuninstall_script',
+    'postuninstall_script'])
+
+
+# results of executable checks for uninstall scripts, keyed by path
+SCRIPT_EXEC_CACHE = {}
+
+
+def isExecutableScript(path):
+    """Returns True if path is an existing, executable file.
+    Uninstall script paths recur across catalog items, so we remember
+    the answer for each path."""
+    if path not in SCRIPT_EXEC_CACHE:
+        # os.access returns False for a path that doesn't exist
+        SCRIPT_EXEC_CACHE[path] = os.access(path, os.X_OK)
+    return SCRIPT_EXEC_CACHE[path]
+
+
 def processRemoval(manifestitem, cataloglist, installinfo):
     """Processes a manifest item; attempts to determine if it
     needs to be removed, and if it can be removed.
@@ -1779,15 +2000,14 @@ def processRemoval(manifestitem, cataloglist, installinfo):
     """
     manifestitemname_withversion = os.path.split(manifestitem)[1]
     munkicommon.display_debug1(
-        '* Processing manifest item %s for removal' %
+        '* Processing manifest item %s for removal',
         manifestitemname_withversion)
 
     (manifestitemname, includedversion) = nameAndVersion(
         manifestitemname_withversion)
 
     # have we processed this already?
-    if manifestitemname in [nameAndVersion(item)[0]
-                            for item in installinfo['processed_installs']]:
+    if manifestitemname in installinfo['_processed_install_names']:
         munkicommon.display_warning('Will not attempt to remove %s '
                                     'because some version of it is in '
                                     'the list of managed installs, or '
@@ -1795,13 +2015,14 @@ def processRemoval(manifestitem, cataloglist, installinfo):
                                     'install.' %
                                     manifestitemname)
         return False
-    elif manifestitemname in installinfo['processed_uninstalls']:
+    elif manifestitemname in installinfo['_processed_uninstalls']:
         munkicommon.display_debug1(
-            '%s has already been processed for removal.' %
+            '%s has already been processed for removal.',
             manifestitemname)
         return True
     else:
         installinfo['processed_uninstalls'].append(manifestitemname)
+        installinfo['_processed_uninstalls'].add(manifestitemname)
 
     infoitems = []
     if includedversion:
@@ -1824,14 +2045,14 @@ def processRemoval(manifestitem, cataloglist, installinfo):
 
     installEvidence = False
     for item in infoitems:
-        munkicommon.display_debug2('Considering item %s-%s for removal info'
-                                   % (item['name'], item['version']))
+        munkicommon.display_debug2('Considering item %s-%s for removal info',
+                                   item['name'], item['version'])
         if evidenceThisIsInstalled(item):
             installEvidence = True
             break
         else:
-            munkicommon.display_debug2('%s-%s not installed.'
-                                       % (item['name'], item['version']))
+            munkicommon.display_debug2('%s-%s not installed.',
+                                       item['name'], item['version'])
 
     if not installEvidence:
         munkicommon.display_detail('%s doesn\'t appear to be installed.' %
@@ -1865,8 +2086,7 @@ def processRemoval(manifestitem, cataloglist, installinfo):
         else:
             # uninstall_method is a local script.
             # Check to see if it exists and is executable
-            if os.path.exists(uninstallmethod) and \
-               os.access(uninstallmethod, os.X_OK):
+            if isExecutableScript(uninstallmethod):
                 uninstall_item = item
 
     if not uninstall_item:
@@ -1888,46 +2108,48 @@ def processRemoval(manifestitem, cataloglist, installinfo):
     # and we're supposed to remove SomePackage--1.0.1.0.0... what do we do?
     #
     dependentitemsremoved = True
-    ManagedInstallDir = munkicommon.pref('ManagedInstallDir')
-    catalogsdir = os.path.join(ManagedInstallDir, 'catalogs')
 
     uninstall_item_name = uninstall_item.get('name')
+    uninstall_item_version = uninstall_item.get('version')
     uninstall_item_name_with_version = (
-        '%s-%s' % (uninstall_item.get('name'), uninstall_item.get('version')))
+        '%s-%s' % (uninstall_item_name, uninstall_item_version))
     alt_uninstall_item_name_with_version = (
-        '%s--%s' % (uninstall_item.get('name'), uninstall_item.get('version')))
-    processednames = []
+        '%s--%s' % (uninstall_item_name, uninstall_item_version))
+    processednames = set()
     for catalogname in cataloglist:
-        localcatalog = os.path.join(catalogsdir, catalogname)
-        catalog_pl = FoundationPlist.readPlist(localcatalog)
-        for item_pl in catalog_pl:
+        if not catalogname in CATALOG:
+            # in case the list refers to a non-existent catalog
+            continue
+        # find the items that require this item, by name or by
+        # name and version, using the catalog's reverse dependency index
+        required_by = CATALOG[catalogname]['required_by']
+        dependentindexes = set(required_by.get(uninstall_item_name, []))
+        dependentindexes.update(
+            required_by.get(uninstall_item_name_with_version, []))
+        dependentindexes.update(
+            required_by.get(alt_uninstall_item_name_with_version, []))
+        items_by_index = CATALOG[catalogname]['items']
+        # process them in catalog order
+        for index in sorted(dependentindexes):
+            item_pl = items_by_index[index]
             name = item_pl.get('name')
-            if name not in processednames:
-                if 'requires' in item_pl:
-                    if (uninstall_item_name in item_pl['requires']
-                        or uninstall_item_name_with_version
-                        in item_pl['requires']
-                        or alt_uninstall_item_name_with_version
-                            in item_pl['requires']):
-                        munkicommon.display_debug1('%s requires %s, checking '
-                                                   'to see if it\'s '
-                                                   'installed...' %
-                                                   (item_pl.get('name'),
-                                                    manifestitemname))
-                        if evidenceThisIsInstalled(item_pl):
-                            munkicommon.display_detail('%s requires %s. '
-                                                       '%s must be removed '
-                                                       'as well.' %
-                                                       (item_pl.get('name'),
-                                                        manifestitemname,
-                                                        item_pl.get('name')))
-                            success = processRemoval(item_pl.get('name'),
-                                                     cataloglist, installinfo)
-                            if not success:
-                                dependentitemsremoved = False
-                                break
-                # record this name so we don't process it again
-                processednames.append(name)
+            if name in processednames:
+                continue
+            # record this name so we don't process it again
+            processednames.add(name)
+            munkicommon.display_debug1('%s requires %s, checking '
+                                       'to see if it\'s '
+                                       'installed...',
+                                       name, manifestitemname)
+            if evidenceThisIsInstalled(item_pl):
+                munkicommon.display_detail('%s requires %s. '
+                                           '%s must be removed '
+                                           'as well.' %
+                                           (name, manifestitemname, name))
+                success = processRemoval(name, cataloglist, installinfo)
+                if not success:
+                    dependentitemsremoved = False
+                    break
 
     if not dependentitemsremoved:
         munkicommon.display_warning('Will not attempt to remove %s because '
@@ -1937,7 +2159,7 @@ def processRemoval(manifestitem, cataloglist, installinfo):
 
     # Finally! We can record the removal information!
     iteminfo = {}
-    iteminfo['name'] = uninstall_item.get('name', '')
+    iteminfo['name'] = uninstall_item_name or ''
     iteminfo['display_name'] = uninstall_item.get('display_name', '')
     iteminfo['description'] = 'Will be removed.'
 
@@ -1949,36 +2171,29 @@ def processRemoval(manifestitem, cataloglist, installinfo):
             munkicommon.display_warning(
                 'Ignoring unattended_uninstall key for %s '
                 'because RestartAction is %s.'
-                % (uninstall_item['name'],
+                % (uninstall_item_name,
                    uninstall_item.get('RestartAction')))
         else:
             iteminfo['unattended_uninstall'] = True
 
     # some keys we'll copy if they exist
-    optionalKeys = ['blocking_applications',
-                    'installs',
-                    'requires',
-                    'update_for',
-                    'preuninstall_script',
-                    'postuninstall_script']
-    for key in optionalKeys:
-        if key in uninstall_item:
-            iteminfo[key] = uninstall_item[key]
+    for key in OPTIONAL_UNINSTALL_KEYS.intersection(uninstall_item):
+        iteminfo[key] = uninstall_item[key]
 
     if packagesToRemove:
         # remove references for each package
         packagesToReallyRemove = []
         for pkg in packagesToRemove:
-            munkicommon.display_debug1('Considering %s for removal...' % pkg)
+            munkicommon.display_debug1('Considering %s for removal...', pkg)
             # find pkg in PKGDATA['pkg_references'] and remove the reference
             # so we only remove packages if we're the last reference to it
             if pkg in PKGDATA['pkg_references']:
-                munkicommon.display_debug1('%s references are: %s' %
-                                           (pkg,
-                                            PKGDATA['pkg_references'][pkg]))
-                PKGDATA['pkg_references'][pkg].remove(iteminfo['name'])
-                if len(PKGDATA['pkg_references'][pkg]) == 0:
-                    munkicommon.display_debug1('Adding %s to removal list.' %
+                pkg_references = PKGDATA['pkg_references'][pkg]
+                munkicommon.display_debug1('%s references are: %s',
+                                           pkg, pkg_references)
+                pkg_references.discard(iteminfo['name'])
+                if not pkg_references:
+                    munkicommon.display_debug1('Adding %s to removal list.',
                                                pkg)
                     packagesToReallyRemove.append(pkg)
             else:
@@ -2029,18 +2244,21 @@ def processRemoval(manifestitem, cataloglist, installinfo):
     # before we add this removal to the list,
     # check for installed updates and add them to the
     # removal list as well:
-    update_list = lookForUpdates(uninstall_item_name, cataloglist)
-    update_list.extend(
-        lookForUpdates(uninstall_item_name_with_version, cataloglist))
-    update_list.extend(
-        lookForUpdates(alt_uninstall_item_name_with_version, cataloglist))
+    update_list = uniqueItems(itertools.chain(
+        lookForUpdates(uninstall_item_name, cataloglist),
+        lookForUpdates(uninstall_item_name_with_version, cataloglist),
+        lookForUpdates(alt_uninstall_item_name_with_version, cataloglist)))
     for update_item in update_list:
+        if (nameAndVersion(update_item)[0] in
+                installinfo['_processed_uninstalls']):
+            # already done; don't bother recursing
+            continue
         # call us recursively...
         unused_result = processRemoval(update_item, cataloglist, installinfo)
 
     # finish recording info for this removal
     iteminfo['installed'] = True
-    iteminfo['installed_version'] = uninstall_item.get('version')
+    iteminfo['installed_version'] = uninstall_item_version
     if 'RestartAction' in uninstall_item:
         iteminfo['RestartAction'] = uninstall_item['RestartAction']
     installinfo['removals'].append(iteminfo)
@@ -2050,11 +2268,36 @@ def processRemoval(manifestitem, cataloglist, installinfo):
     return True
 
 
+# parsed manifests, keyed by path. Each value is a
+# (file signature, plist) tuple, so we notice when the file changes.
+MANIFEST_DATA_CACHE = {}
+
+
+def readManifestPlist(manifestpath):
+    '''Returns FoundationPlist.readPlist(manifestpath), but only parses
+    the file if it has changed since we last read it. The same manifest
+    is read once for each key we process, so this saves many parses.
+    Callers must not modify the returned object.'''
+    try:
+        stat = os.stat(manifestpath)
+    except OSError:
+        # let readPlist report the problem
+        return FoundationPlist.readPlist(manifestpath)
+    # writes and downloads replace the file, so the inode changes too
+    signature = (stat.st_ino, stat.st_mtime, stat.st_size)
+    cached = MANIFEST_DATA_CACHE.get(manifestpath)
+    if cached and cached[0] == signature:
+        return cached[1]
+    plist = FoundationPlist.readPlist(manifestpath)
+    MANIFEST_DATA_CACHE[manifestpath] = (signature, plist)
+    return plist
+
+
 def getManifestData(manifestpath):
     '''Reads a manifest file, returns a dictionary-like object.'''
     plist = {}
     try:
-        plist = FoundationPlist.readPlist(manifestpath)
+        plist = readManifestPlist(manifestpath)
     except FoundationPlist.NSPropertyListSerializationException:
         munkicommon.display_error('Could not read plist: %s', manifestpath)
         if os.path.exists(manifestpath):
@@ -2082,50 +2325,66 @@ def getCatalogs(cataloglist):
     dictionary.
     """
     # global CATALOG
-    catalogbaseurl = munkicommon.pref('CatalogURL') or \
-        munkicommon.pref('SoftwareRepoURL') + '/catalogs/'
+    catalogbaseurl = cachedPref('CatalogURL') or \
+        cachedPref('SoftwareRepoURL') + '/catalogs/'
     if not catalogbaseurl.endswith('?') and not catalogbaseurl.endswith('/'):
         catalogbaseurl = catalogbaseurl + '/'
     munkicommon.display_debug2('Catalog base URL is: %s' % catalogbaseurl)
-    catalog_dir = os.path.join(munkicommon.pref('ManagedInstallDir'),
+    catalog_dir = os.path.join(cachedPref('ManagedInstallDir'),
                                'catalogs')
 
-    for catalogname in cataloglist:
-        if not catalogname in CATALOG:
-            catalogurl = catalogbaseurl + urllib2.quote(catalogname)
-            catalogpath = os.path.join(catalog_dir, catalogname)
-            munkicommon.display_detail('Getting catalog %s...' % catalogname)
-            message = 'Retreiving catalog "%s"...' % catalogname
+    # download all the catalogs we don't have yet at once...
+    catalognames = [catalogname for catalogname in uniqueItems(cataloglist)
+                    if not catalogname in CATALOG]
+    resources = []
+    for catalogname in catalognames:
+        catalogurl = catalogbaseurl + urllib2.quote(catalogname)
+        catalogpath = os.path.join(catalog_dir, catalogname)
+        munkicommon.display_detail('Getting catalog %s...' % catalogname)
+        message = 'Retreiving catalog "%s"...' % catalogname
+        resources.append((catalogurl, catalogpath, message))
+    results = fetchResources(resources)
+
+    # ...then load them in order
+    for catalogname, resource, (changed, err) in zip(
+            catalognames, resources, results):
+        catalogpath = resource[1]
+        if err:
+            munkicommon.display_error(
+                'Could not retrieve catalog %s from server.' %
+                catalogname)
+            munkicommon.display_error(err)
+
+        else:
             try:
-                unused_value = getResourceIfChangedAtomically(
-                    catalogurl, catalogpath, message=message)
-            except fetch.MunkiDownloadError, err:
+                catalogdb = loadCatalogDB(catalogpath, changed)
+            except FoundationPlist.NSPropertyListSerializationException:
                 munkicommon.display_error(
-                    'Could not retrieve catalog %s from server.' %
-                    catalogname)
-                munkicommon.display_error(err)
-
-            else:
+                    'Retreived catalog %s is invalid.' % catalogname)
                 try:
-                    catalogdata = FoundationPlist.readPlist(catalogpath)
-                except FoundationPlist.NSPropertyListSerializationException:
-                    munkicommon.display_error(
-                        'Retreived catalog %s is invalid.' % catalogname)
-                    try:
-                        os.unlink(catalogpath)
-                    except (OSError, IOError):
-                        pass
-                else:
-                    CATALOG[catalogname] = makeCatalogDB(catalogdata)
+                    os.unlink(catalogpath)
+                except (OSError, IOError):
+                    pass
+            else:
+                CATALOG[catalogname] = catalogdb
+                # cached lookups may be stale now
+                ITEM_DETAIL_CACHE.clear()
+                UPDATES_CACHE.clear()
+                VERSION_UPDATES_CACHE.clear()
 
 
 def cleanUpCatalogs():
     """Removes any catalog files that are no longer in use by this client"""
-    catalog_dir = os.path.join(munkicommon.pref('ManagedInstallDir'),
+    catalog_dir = os.path.join(cachedPref('ManagedInstallDir'),
                                'catalogs')
-    for item in os.listdir(catalog_dir):
-        if item not in CATALOG.keys():
-            os.unlink(os.path.join(catalog_dir, item))
+    # also clean up our saved DBs for those catalogs
+    for directory in [catalog_dir, getCatalogDBDir()]:
+        if not os.path.isdir(directory):
+            continue
+        stale_items = [item for item in os.listdir(directory)
+                       if item not in CATALOG]
+        for item in stale_items:
+            os.unlink(os.path.join(directory, item))
 
 
 class ManifestException(Exception):
@@ -2137,6 +2396,68 @@ class ManifestException(Exception):
 MANIFESTS = {}
 
 
+def getManifestBaseURL():
+    """Returns the base URL for manifests on the Munki server."""
+    manifestbaseurl = cachedPref('ManifestURL') or \
+        cachedPref('SoftwareRepoURL') + '/manifests/'
+    if not manifestbaseurl.endswith('?') and \
+       not manifestbaseurl.endswith('/'):
+        manifestbaseurl = manifestbaseurl + '/'
+    return manifestbaseurl
+
+
+def prefetchManifests(manifestpath):
+    """Downloads the manifests included by the manifest at manifestpath,
+    and those they include in turn, several at a time.
+
+    Valid manifests are recorded in MANIFESTS, so getmanifest won't need
+    to ask the server for them again while we process them. Any manifest
+    that fails here is left for getmanifest to retry and report.
+    Manifests included by conditional_items are not prefetched, since we
+    may not need them.
+    """
+    try:
+        included = readManifestPlist(manifestpath).get(
+            'included_manifests') or []
+    except FoundationPlist.NSPropertyListSerializationException:
+        return
+    manifestbaseurl = getManifestBaseURL()
+    manifest_dir = os.path.join(cachedPref('ManagedInstallDir'),
+                                'manifests')
+    message = 'Retreiving list of software for this machine...'
+    seen = set(MANIFESTS)
+    while included:
+        resources = []
+        for partialurl in included:
+            manifestname = os.path.split(partialurl)[1]
+            if manifestname not in seen:
+                seen.add(manifestname)
+                munkicommon.display_detail(
+                    'Getting manifest %s...' % partialurl)
+                resources.append((manifestbaseurl + urllib2.quote(partialurl),
+                                  os.path.join(manifest_dir, manifestname),
+                                  message))
+        included = []
+        for resource, (unused_changed, err) in zip(
+                resources, fetchResources(resources)):
+            if err:
+                continue
+            nestedmanifestpath = resource[1]
+            try:
+                manifestdata = readManifestPlist(nestedmanifestpath)
+            except FoundationPlist.NSPropertyListSerializationException:
+                # remove it, so getmanifest downloads it again instead
+                # of trusting an unchanged copy
+                try:
+                    os.unlink(nestedmanifestpath)
+                except (OSError, IOError):
+                    pass
+                continue
+            MANIFESTS[os.path.basename(nestedmanifestpath)] = (
+                nestedmanifestpath)
+            included.extend(manifestdata.get('included_manifests') or [])
+
+
 def getmanifest(partialurl, suppress_errors=False):
     """Gets a manifest from the server.
 
@@ -2144,34 +2465,34 @@ def getmanifest(partialurl, suppress_errors=False):
       string local path to the downloaded manifest.
     """
     # global MANIFESTS
-    manifestbaseurl = munkicommon.pref('ManifestURL') or \
-        munkicommon.pref('SoftwareRepoURL') + '/manifests/'
-    if not manifestbaseurl.endswith('?') and \
-       not manifestbaseurl.endswith('/'):
-        manifestbaseurl = manifestbaseurl + '/'
-    manifest_dir = os.path.join(munkicommon.pref('ManagedInstallDir'),
-                                'manifests')
-
-    if (partialurl.startswith('http://') or partialurl.startswith('https://')
-            or partialurl.startswith('file:/')):
+    is_primary_manifest = partialurl.startswith(
+        ('http://', 'https://', 'file:/'))
+    if is_primary_manifest:
         # then it's really a request for the client's primary manifest
-        manifesturl = partialurl
-        partialurl = 'client_manifest'
         manifestname = 'client_manifest.plist'
     else:
         # request for nested manifest
         manifestname = os.path.split(partialurl)[1]
-        manifesturl = manifestbaseurl + urllib2.quote(partialurl)
 
     if manifestname in MANIFESTS:
         return MANIFESTS[manifestname]
 
-    munkicommon.display_debug2('Manifest base URL is: %s' % manifestbaseurl)
+    manifestbaseurl = getManifestBaseURL()
+    manifest_dir = os.path.join(cachedPref('ManagedInstallDir'),
+                                'manifests')
+
+    if is_primary_manifest:
+        manifesturl = partialurl
+        partialurl = 'client_manifest'
+    else:
+        manifesturl = manifestbaseurl + urllib2.quote(partialurl)
+
+    munkicommon.display_debug2('Manifest base URL is: %s', manifestbaseurl)
     munkicommon.display_detail('Getting manifest %s...' % partialurl)
     manifestpath = os.path.join(manifest_dir, manifestname)
     message = 'Retreiving list of software for this machine...'
     try:
-        unused_value = getResourceIfChangedAtomically(
+        changed = getResourceIfChangedAtomically(
             manifesturl, manifestpath, message=message)
     except fetch.MunkiDownloadError, err:
         if not suppress_errors:
@@ -2181,9 +2502,15 @@ def getmanifest(partialurl, suppress_errors=False):
             munkicommon.display_error(str(err))
         return None
 
+    if not changed:
+        # we validated this copy when we downloaded it on an earlier run;
+        # invalid manifests are removed, so it must still be good
+        MANIFESTS[manifestname] = manifestpath
+        return manifestpath
+
     try:
         # read plist to see if it is valid
-        unused_data = FoundationPlist.readPlist(manifestpath)
+        unused_data = readManifestPlist(manifestpath)
     except FoundationPlist.NSPropertyListSerializationException:
         errormsg = 'manifest returned for %s is invalid.' % partialurl
         munkicommon.display_error(errormsg)
@@ -2198,36 +2525,60 @@ def getmanifest(partialurl, suppress_errors=False):
         return manifestpath
 
 
+# client certificate path and common name, looked up once per run
+CLIENT_CERT = {}
+
+
+def getClientCertPath():
+    """Returns the path to the client certificate: the ClientCertificatePath
+    preference if set, otherwise the first of cert.pem, client.pem and
+    munki.pem found in ManagedInstallDir/certs (or the last of those if
+    none are found)."""
+    if not 'path' in CLIENT_CERT:
+        client_cert_path = cachedPref('ClientCertificatePath')
+        if not client_cert_path:
+            ManagedInstallDir = cachedPref('ManagedInstallDir')
+            for name in ['cert.pem', 'client.pem', 'munki.pem']:
+                client_cert_path = os.path.join(ManagedInstallDir,
+                                                'certs', name)
+                if os.path.exists(client_cert_path):
+                    break
+        CLIENT_CERT['path'] = client_cert_path
+    return CLIENT_CERT['path']
+
+
+def getClientCertCommonName():
+    """Returns the common name from the client certificate."""
+    if not 'commonName' in CLIENT_CERT:
+        fileobj = open(getClientCertPath())
+        data = fileobj.read()
+        fileobj.close()
+        x509 = load_certificate(FILETYPE_PEM, data)
+        CLIENT_CERT['commonName'] = x509.get_subject().commonName
+    return CLIENT_CERT['commonName']
+
+
+def quoteClientIdentifier(clientidentifier):
+    """Returns clientidentifier quoted for use in a manifest URL."""
+    if isinstance(clientidentifier, unicode):
+        clientidentifier = clientidentifier.encode('utf-8')
+    return urllib2.quote(clientidentifier)
+
+
 def getPrimaryManifest(alternate_id):
     """Gets the client manifest from the server."""
     manifest = ""
-    manifesturl = munkicommon.pref('ManifestURL') or \
-        munkicommon.pref('SoftwareRepoURL') + '/manifests/'
-    if not manifesturl.endswith('?') and not manifesturl.endswith('/'):
-        manifesturl = manifesturl + '/'
-    munkicommon.display_debug2('Manifest base URL is: %s' % manifesturl)
+    manifesturl = getManifestBaseURL()
+    munkicommon.display_debug2('Manifest base URL is: %s', manifesturl)
 
-    clientidentifier = alternate_id or munkicommon.pref('ClientIdentifier')
+    clientidentifier = alternate_id or cachedPref('ClientIdentifier')
 
-    if not alternate_id and munkicommon.pref('UseClientCertificate') and \
-            munkicommon.pref('UseClientCertificateCNAsClientIdentifier'):
+    if not alternate_id and cachedPref('UseClientCertificate') and \
+            cachedPref('UseClientCertificateCNAsClientIdentifier'):
         # we're to use the client cert CN as the clientidentifier
-        if munkicommon.pref('UseClientCertificate'):
-            # find the client cert
-            client_cert_path = munkicommon.pref('ClientCertificatePath')
-            if not client_cert_path:
-                ManagedInstallDir = munkicommon.pref('ManagedInstallDir')
-                for name in ['cert.pem', 'client.pem', 'munki.pem']:
-                    client_cert_path = os.path.join(ManagedInstallDir,
-                                                    'certs', name)
-                    if os.path.exists(client_cert_path):
-                        break
-            if client_cert_path and os.path.exists(client_cert_path):
-                fileobj = open(client_cert_path)
-                data = fileobj.read()
-                fileobj.close()
-                x509 = load_certificate(FILETYPE_PEM, data)
-                clientidentifier = x509.get_subject().commonName
+        client_cert_path = getClientCertPath()
+        if client_cert_path and os.path.exists(client_cert_path):
+            clientidentifier = getClientCertCommonName()
 
     try:
         if not clientidentifier:
@@ -2236,15 +2587,17 @@ def getPrimaryManifest(alternate_id):
             clientidentifier = hostname
             munkicommon.display_detail('No client id specified. '
                                        'Requesting %s...' % clientidentifier)
-            manifest = getmanifest(manifesturl + clientidentifier,
-                                   suppress_errors=True)
+            manifest = getmanifest(
+                manifesturl + quoteClientIdentifier(clientidentifier),
+                suppress_errors=True)
             if not manifest:
                 # try the short hostname
                 clientidentifier = hostname.split('.')[0]
                 munkicommon.display_detail('Request failed. Trying %s...' %
                                            clientidentifier)
-                manifest = getmanifest(manifesturl + clientidentifier,
-                                       suppress_errors=True)
+                manifest = getmanifest(
+                    manifesturl + quoteClientIdentifier(clientidentifier),
+                    suppress_errors=True)
                 if not manifest:
                     # last resort - try for the site_default manifest
                     clientidentifier = 'site_default'
@@ -2254,7 +2607,7 @@ def getPrimaryManifest(alternate_id):
 
         if not manifest:
             manifest = getmanifest(
-                manifesturl + urllib2.quote(clientidentifier.encode('utf-8')))
+                manifesturl + quoteClientIdentifier(clientidentifier))
         if manifest:
             # record this info for later
             munkicommon.report['ManifestName'] = clientidentifier
@@ -2295,11 +2648,10 @@ def checkServer(url):
         return (-1, 'Bad URL')
     if len(netlocparts) == 2:
         port = int(netlocparts[1])
-    sock = socket.socket()
-    # set timeout to 5 secs
-    sock.settimeout(5.0)
     try:
-        sock.connect((host, port))
+        # try each address for host in turn; give up after 5 secs.
+        # A TCP connection is all we need to know the server is there.
+        sock = socket.create_connection((host, port), 5.0)
         sock.close()
         return (0, 'OK')
     except socket.error, err:
@@ -2337,6 +2689,36 @@ def getDownloadCachePath(destinationpathprefix, url):
         destinationpathprefix, getInstallerItemBasename(url))
 
 
+def installInfoUnchanged(installinfopath, installinfo):
+    """Returns True if the file at installinfopath already holds
+    installinfo.
+
+    If the bytes on disk match what we'd write, nothing changed and we
+    needn't parse the old file. Binary plists keep each dictionary's own
+    key order, though, so a file written back by the installer or
+    checkForceInstallPackages can differ byte-wise with the same contents;
+    in that case we compare the parsed contents. A missing or unreadable
+    file compares as different, so it gets replaced."""
+    try:
+        fileobj = open(installinfopath, 'rb')
+        try:
+            oldinstallinfodata = fileobj.read()
+        finally:
+            fileobj.close()
+    except (OSError, IOError):
+        return False
+    if oldinstallinfodata == FoundationPlist.writePlistToString(
+            installinfo, binary=True):
+        return True
+    if not oldinstallinfodata:
+        return False
+    try:
+        return (FoundationPlist.readPlistFromString(oldinstallinfodata)
+                == installinfo)
+    except FoundationPlist.NSPropertyListSerializationException:
+        return False
+
+
 MACHINE = {}
 CONDITIONS = {}
 
@@ -2356,7 +2738,12 @@ def check(client_id='', localmanifestpath=None):
     CONDITIONS = munkicommon.getConditions()
     munkicommon.report['ConditionalItems'] = CONDITIONS
 
-    ManagedInstallDir = munkicommon.pref('ManagedInstallDir')
+    # start with fresh preference values
+    PREFS.clear()
+    CERT_INFO.clear()
+    CLIENT_CERT.clear()
+    SCRIPT_EXEC_CACHE.clear()
+    ManagedInstallDir = cachedPref('ManagedInstallDir')
     if munkicommon.munkistatusoutput:
         munkistatus.activate()
 
@@ -2380,6 +2767,18 @@ def check(client_id='', localmanifestpath=None):
         installinfo['optional_installs'] = []
         installinfo['managed_installs'] = []
         installinfo['removals'] = []
+        # lookup tables used only while processing manifests;
+        # keys starting with '_' are stripped before installinfo is saved
+        installinfo['_processed_installs'] = set()
+        installinfo['_processed_install_names'] = set()
+        installinfo['_processed_uninstalls'] = set()
+        installinfo['_managed_updates'] = set()
+        installinfo['_optional_installs_names'] = set()
+
+        # get all the included manifests we'll need up front
+        prefetchManifests(mainmanifestpath)
+        if munkicommon.stopRequested():
+            return 0
 
         # set up INFO_OBJECT for conditional item comparisons
         makePredicateInfoObject()
@@ -2405,14 +2804,15 @@ def check(client_id='', localmanifestpath=None):
 
         # now check for implicit removals
         # use catalogs from main manifest
-        cataloglist = getManifestValueForKey(mainmanifestpath, 'catalogs')
-        autoremovalitems = getAutoRemovalItems(installinfo, cataloglist)
+        maincataloglist = getManifestValueForKey(mainmanifestpath, 'catalogs')
+        autoremovalitems = getAutoRemovalItems(installinfo, maincataloglist)
         if autoremovalitems:
             munkicommon.display_detail('**Checking for implicit removals**')
         for item in autoremovalitems:
             if munkicommon.stopRequested():
                 return 0
-            unused_result = processRemoval(item, cataloglist, installinfo)
+            unused_result = processRemoval(item, maincataloglist,
+                                           installinfo)
 
         # look for additional updates
         munkicommon.display_detail('**Checking for managed updates**')
@@ -2437,7 +2837,8 @@ def check(client_id='', localmanifestpath=None):
             try:
                 plist = FoundationPlist.readPlist(usermanifest)
                 if plist:
-                    FoundationPlist.writePlist(plist, selfservemanifest)
+                    FoundationPlist.writePlist(plist, selfservemanifest,
+                                               binary=True)
                     # now remove the user-generated manifest
                     try:
                         os.unlink(usermanifest)
@@ -2452,14 +2853,14 @@ def check(client_id='', localmanifestpath=None):
                 except OSError:
                     pass
 
+        selfservedata = None
         if os.path.exists(selfservemanifest):
             # use catalogs from main manifest for self-serve manifest
-            cataloglist = getManifestValueForKey(
-                mainmanifestpath, 'catalogs')
+            cataloglist = maincataloglist
             munkicommon.display_detail(
                 '**Processing self-serve choices**')
-            selfserveinstalls = getManifestValueForKey(selfservemanifest,
-                                                       'managed_installs')
+            selfservedata = getManifestData(selfservemanifest)
+            selfserveinstalls = selfservedata.get('managed_installs')
             available_optional_installs = [item['name']
                                            for item in installinfo.get('optional_installs', [])]
             if selfserveinstalls:
@@ -2476,46 +2877,67 @@ def check(client_id='', localmanifestpath=None):
                                   installinfo, cataloglist)
 
             # update optional_installs with install/removal info
+            managed_install_names = set(
+                item['name'] for item in installinfo['managed_installs']
+                if 'name' in item)
+            removal_names = set(
+                item['name'] for item in installinfo['removals']
+                if 'name' in item)
             for item in installinfo['optional_installs']:
                 if (not item.get('installed') and
-                    isItemInInstallInfo(item,
-                                        installinfo['managed_installs'])):
+                        item.get('name') in managed_install_names):
                     item['will_be_installed'] = True
                 elif (item.get('installed') and
-                      isItemInInstallInfo(item,
-                                          installinfo['removals'])):
+                      item.get('name') in removal_names):
                     item['will_be_removed'] = True
 
-        # filter managed_installs to get items already installed
-        installed_items = [item.get('name', '')
-                           for item in installinfo['managed_installs']
-                           if item.get('installed')]
-        # filter managed_installs to get problem items:
-        # not installed, but no installer item
-        problem_items = [item
-                         for item in installinfo['managed_installs']
-                         if item.get('installed') == False and
-                         not item.get('installer_item')]
-        # filter removals to get items already removed
-        # (or never installed)
-        removed_items = [item.get('name', '')
-                         for item in installinfo['removals']
-                         if item.get('installed') == False]
-
-        if os.path.exists(selfservemanifest):
+        # drop our processing-only lookup tables; they can't be
+        # serialized to a plist and the installer doesn't need them
+        for key in [key for key in installinfo if key.startswith('_')]:
+            del installinfo[key]
+
+        # sort managed_installs in a single pass into items already
+        # installed, problem items (not installed, but no installer item)
+        # and items that need action (those with an installer item)
+        installed_items = []
+        problem_items = []
+        items_to_install = []
+        for item in installinfo['managed_installs']:
+            installed = item.get('installed')
+            has_installer_item = bool(item.get('installer_item'))
+            if installed:
+                installed_items.append(item.get('name', ''))
+            elif installed == False and not has_installer_item:
+                problem_items.append(item)
+            if has_installer_item:
+                items_to_install.append(item)
+        # likewise sort removals into items already removed
+        # (or never installed) and items that need action
+        removed_items = []
+        items_to_remove = []
+        for item in installinfo['removals']:
+            installed = item.get('installed')
+            if installed:
+                items_to_remove.append(item)
+            elif installed == False:
+                removed_items.append(item.get('name', ''))
+
+        if selfservedata and os.path.exists(selfservemanifest):
             # for any item in the managed_uninstalls in the self-serve
             # manifest that is not installed, we should remove it from
-            # the list
-            try:
-                plist = FoundationPlist.readPlist(selfservemanifest)
-            except FoundationPlist.FoundationPlistException:
-                pass
-            else:
-                plist['managed_uninstalls'] = \
-                    [item for item in plist.get('managed_uninstalls', [])
-                        if item not in removed_items]
+            # the list. We already have the manifest's contents; copy
+            # them, since the parsed manifest cache must not be modified.
+            removed_names = set(removed_items)
+            selfserveuninstalls = selfservedata.get('managed_uninstalls', [])
+            filtereduninstalls = [item for item in selfserveuninstalls
+                                  if item not in removed_names]
+            if len(filtereduninstalls) != len(selfserveuninstalls):
+                # something was removed, so save the new list
+                plist = dict(selfservedata)
+                plist['managed_uninstalls'] = filtereduninstalls
                 try:
-                    FoundationPlist.writePlist(plist, selfservemanifest)
+                    FoundationPlist.writePlist(plist, selfservemanifest,
+                                               binary=True)
                 except FoundationPlist.FoundationPlistException:
                     pass
 
@@ -2535,12 +2957,8 @@ def check(client_id='', localmanifestpath=None):
 
         # filter managed_installs and removals lists
         # so they have only items that need action
-        installinfo['managed_installs'] = \
-            [item for item in installinfo['managed_installs']
-             if item.get('installer_item')]
-        installinfo['removals'] = \
-            [item for item in installinfo['removals']
-                if item.get('installed')]
+        installinfo['managed_installs'] = items_to_install
+        installinfo['removals'] = items_to_remove
 
         # record the filtered lists
         munkicommon.report['ItemsToInstall'] = installinfo['managed_installs']
@@ -2556,59 +2974,57 @@ def check(client_id='', localmanifestpath=None):
         # updatecheck run, but later removed from the manifest
         # before it is installed or removed - so the cached item
         # is no longer needed.
-        cache_list = [item['installer_item']
-                      for item in installinfo.get('managed_installs', [])]
-        cache_list.extend([item['uninstaller_item']
-                           for item in installinfo.get('removals', [])
-                           if item.get('uninstaller_item')])
+        cache_set = set(item['installer_item']
+                        for item in installinfo.get('managed_installs', []))
+        cache_set.update(item['uninstaller_item']
+                         for item in installinfo.get('removals', [])
+                         if item.get('uninstaller_item'))
         cachedir = os.path.join(ManagedInstallDir, 'Cache')
-        for item in munkicommon.listdir(cachedir):
+        cache_contents = munkicommon.listdir(cachedir)
+        # a snapshot of the directory, so we needn't stat for each
+        # partial download's full download
+        cache_contents_set = set(cache_contents)
+        stale_items = []
+        for item in cache_contents:
             if item.endswith('.download'):
                 # we have a partial download here
                 # remove the '.download' from the end of the filename
                 fullitem = os.path.splitext(item)[0]
-                if os.path.exists(os.path.join(cachedir, fullitem)):
+                if fullitem in cache_contents_set:
                     # we have a partial and a full download
                     # for the same item. (This shouldn't happen.)
                     # remove the partial download.
-                    os.unlink(os.path.join(cachedir, item))
-                elif problem_items == []:
+                    stale_items.append(item)
+                elif not problem_items:
                     # problem items is our list of items
                     # that need to be installed but are missing
                     # the installer_item; these might be partial
                     # downloads. So if we have no problem items, it's
                     # OK to get rid of any partial downloads hanging
                     # around.
-                    os.unlink(os.path.join(cachedir, item))
-            elif item not in cache_list:
+                    stale_items.append(item)
+            elif item not in cache_set:
                 munkicommon.display_detail(
                     'Removing %s from cache' % item)
+                stale_items.append(item)
+        # now remove everything we don't need in one go
+        for item in stale_items:
+            try:
                 os.unlink(os.path.join(cachedir, item))
+            except OSError, err:
+                munkicommon.display_warning(
+                    'Could not remove %s from cache: %s' % (item, err))
 
         # write out install list so our installer
         # can use it to install things in the right order
-        installinfochanged = True
         installinfopath = os.path.join(ManagedInstallDir, 'InstallInfo.plist')
-        if os.path.exists(installinfopath):
-            try:
-                oldinstallinfo = FoundationPlist.readPlist(installinfopath)
-            except FoundationPlist.NSPropertyListSerializationException:
-                oldinstallinfo = None
-                munkicommon.display_error(
-                    'Could not read InstallInfo.plist. Deleting...')
-                try:
-                    os.unlink(installinfopath)
-                except OSError, e:
-                    munkicommon.display_error(
-                        'Failed to delete InstallInfo.plist: %s', str(e))
-            if oldinstallinfo == installinfo:
-                installinfochanged = False
-                munkicommon.display_detail('No change in InstallInfo.')
-
-        if installinfochanged:
-            FoundationPlist.writePlist(installinfo,
-                                       os.path.join(ManagedInstallDir,
-                                                    'InstallInfo.plist'))
+        if installInfoUnchanged(installinfopath, installinfo):
+            munkicommon.display_detail('No change in InstallInfo.')
+        else:
+            # writePlist replaces the file atomically. InstallInfo is only
+            # read by munki's tools, so use the quicker binary format
+            FoundationPlist.writePlist(installinfo, installinfopath,
+                                       binary=True)
     else:
         # couldn't get a primary manifest. Check to see if we have a valid
         # install/remove list from an earlier run.
@@ -2627,6 +3043,8 @@ def check(client_id='', localmanifestpath=None):
 
     installcount = len(installinfo.get('managed_installs', []))
     removalcount = len(installinfo.get('removals', []))
+    restart_required = False
+    logout_required = False
 
     munkicommon.log('')
     if installcount:
@@ -2634,32 +3052,39 @@ def check(client_id='', localmanifestpath=None):
         munkicommon.display_info(
             'The following items will be installed or upgraded:')
     for item in installinfo.get('managed_installs', []):
-        if item.get('installer_item'):
-            munkicommon.display_info('    + %s-%s' %
-                                     (item.get('name', ''),
-                                      item.get('version_to_install', '')))
-            if item.get('description'):
-                munkicommon.display_info('        %s' % item['description'])
-            if item.get('RestartAction') == 'RequireRestart' or \
-               item.get('RestartAction') == 'RecommendRestart':
-                munkicommon.display_info('       *Restart required')
-                munkicommon.report['RestartRequired'] = True
-            if item.get('RestartAction') == 'RequireLogout':
-                munkicommon.display_info('       *Logout required')
-                munkicommon.report['LogoutRequired'] = True
+        if not item.get('installer_item'):
+            continue
+        restart_action = item.get('RestartAction')
+        munkicommon.display_info('    + %s-%s' %
+                                 (item.get('name', ''),
+                                  item.get('version_to_install', '')))
+        if item.get('description'):
+            munkicommon.display_info('        %s' % item['description'])
+        if restart_action in RESTART_ACTIONS:
+            munkicommon.display_info('       *Restart required')
+            restart_required = True
+        if restart_action == 'RequireLogout':
+            munkicommon.display_info('       *Logout required')
+            logout_required = True
 
     if removalcount:
         munkicommon.display_info('The following items will be removed:')
     for item in installinfo.get('removals', []):
-        if item.get('installed'):
-            munkicommon.display_info('    - %s' % item.get('name'))
-            if item.get('RestartAction') == 'RequireRestart' or \
-               item.get('RestartAction') == 'RecommendRestart':
-                munkicommon.display_info('       *Restart required')
-                munkicommon.report['RestartRequired'] = True
-            if item.get('RestartAction') == 'RequireLogout':
-                munkicommon.display_info('       *Logout required')
-                munkicommon.report['LogoutRequired'] = True
+        if not item.get('installed'):
+            continue
+        restart_action = item.get('RestartAction')
+        munkicommon.display_info('    - %s' % item.get('name'))
+        if restart_action in RESTART_ACTIONS:
+            munkicommon.display_info('       *Restart required')
+            restart_required = True
+        if restart_action == 'RequireLogout':
+            munkicommon.display_info('       *Logout required')
+            logout_required = True
+
+    if restart_required:
+        munkicommon.report['RestartRequired'] = True
+    if logout_required:
+        munkicommon.report['LogoutRequired'] = True
 
     if installcount == 0 and removalcount == 0:
         munkicommon.display_info(
@@ -2682,11 +3107,8 @@ def discardTimeZoneFromDate(the_date):
     In New York (EDT), it becomes '2011-06-20 12:00:00 -0400'.
     """
     # get local offset
-    offset = the_date.descriptionWithCalendarFormat_timeZone_locale_(
-        '%z', None, None)
-    hour_offset = int(offset[0:3])
-    minute_offset = int(offset[0] + offset[3:])
-    seconds_offset = 60 * 60 * hour_offset + 60 * minute_offset
+    seconds_offset = NSTimeZone.localTimeZone().secondsFromGMTForDate_(
+        the_date)
     # return new NSDate minus local_offset
     return the_date.dateByAddingTimeInterval_(-seconds_offset)
 
@@ -2707,7 +3129,7 @@ def checkForceInstallPackages():
     """
     result = None
 
-    ManagedInstallDir = munkicommon.pref('ManagedInstallDir')
+    ManagedInstallDir = cachedPref('ManagedInstallDir')
     installinfopath = os.path.join(ManagedInstallDir, 'InstallInfo.plist')
 
     try:
@@ -2715,66 +3137,86 @@ def checkForceInstallPackages():
     except FoundationPlist.NSPropertyListSerializationException:
         return result
 
-    now = NSDate.date()
-    now_xhours = NSDate.dateWithTimeIntervalSinceNow_(
-        FORCE_INSTALL_WARNING_HOURS * 3600)
-    writeback = False
-
-    for i in xrange(len(installinfo.get('managed_installs', []))):
-        install = installinfo['managed_installs'][i]
-        force_install_after_date = install.get('force_install_after_date')
+    if not any(install.get('force_install_after_date')
+               for install in installinfo.get('managed_installs', [])):
+        # nothing to force install, which is the usual case
+        return result
 
-        if force_install_after_date:
-            force_install_after_date = discardTimeZoneFromDate(
-                force_install_after_date)
-            munkicommon.display_debug1(
-                'Forced install for %s at %s',
-                install['name'], force_install_after_date)
-            if now >= force_install_after_date:
-                result = 'now'
-                if install.get('RestartAction'):
-                    if install['RestartAction'] == 'RequireLogout':
-                        result = 'logout'
-                    elif install['RestartAction'] == 'RequireRestart':
-                        result = 'restart'
-                elif not install.get('unattended_install', False):
-                    munkicommon.display_debug1(
-                        'Setting unattended install for %s', install['name'])
-                    install['unattended_install'] = True
-                    installinfo['managed_installs'][i] = install
-                    writeback = True
+    # Autorelease pool for the NSDates we make in the loop
+    pool = NSAutoreleasePool.alloc().init()
+    try:
+        now = NSDate.date()
+        now_xhours = NSDate.dateWithTimeIntervalSinceNow_(
+            FORCE_INSTALL_WARNING_HOURS * 3600)
+        writeback = False
+        # many items often share the same date; convert each date only once
+        converted_dates = {}
+
+        for i in xrange(len(installinfo.get('managed_installs', []))):
+            install = installinfo['managed_installs'][i]
+            force_install_after_date = install.get('force_install_after_date')
+
+            if force_install_after_date:
+                date_key = (
+                    force_install_after_date.timeIntervalSinceReferenceDate())
+                if not date_key in converted_dates:
+                    converted_dates[date_key] = discardTimeZoneFromDate(
+                        force_install_after_date)
+                force_install_after_date = converted_dates[date_key]
+                munkicommon.display_debug1(
+                    'Forced install for %s at %s',
+                    install['name'], force_install_after_date)
+                if now >= force_install_after_date:
+                    result = 'now'
+                    if install.get('RestartAction'):
+                        if install['RestartAction'] == 'RequireLogout':
+                            result = 'logout'
+                        elif install['RestartAction'] == 'RequireRestart':
+                            result = 'restart'
+                    elif not install.get('unattended_install', False):
+                        munkicommon.display_debug1(
+                            'Setting unattended install for %s',
+                            install['name'])
+                        install['unattended_install'] = True
+                        installinfo['managed_installs'][i] = install
+                        writeback = True
+
+                if now_xhours >= force_install_after_date:
+                    if not result:
+                        result = 'soon'
+
+        if writeback:
+            FoundationPlist.writePlist(installinfo, installinfopath,
+                                       binary=True)
+    finally:
+        del pool
 
-            if now_xhours >= force_install_after_date:
-                if not result:
-                    result = 'soon'
+    return result
 
-    if writeback:
-        FoundationPlist.writePlist(installinfo, installinfopath)
 
-    return result
+# CA and client cert info for connections to the Munki server
+CERT_INFO = {}
 
 
-def getResourceIfChangedAtomically(url,
-                                   destinationpath,
-                                   message=None,
-                                   resume=False,
-                                   expected_hash=None,
-                                   verify=False):
-    '''Gets a given URL from the Munki server. Sets up cert/CA info if it
-    exists, and adds any additional headers'''
+def getCertInfo():
+    '''Returns a dictionary of CA and client cert info for connections to
+    the Munki server. It's the same for every request, so we look it up
+    only once per run.'''
+    if CERT_INFO:
+        return CERT_INFO
 
-    ManagedInstallDir = munkicommon.pref('ManagedInstallDir')
+    ManagedInstallDir = cachedPref('ManagedInstallDir')
     # get server CA cert if it exists so we can verify the munki server
     ca_cert_path = None
     ca_dir_path = None
-    if munkicommon.pref('SoftwareRepoCAPath'):
-        CA_path = munkicommon.pref('SoftwareRepoCAPath')
+    if cachedPref('SoftwareRepoCAPath'):
+        CA_path = cachedPref('SoftwareRepoCAPath')
         if os.path.isfile(CA_path):
             ca_cert_path = CA_path
         elif os.path.isdir(CA_path):
             ca_dir_path = CA_path
-    if munkicommon.pref('SoftwareRepoCACertificate'):
-        ca_cert_path = munkicommon.pref('SoftwareRepoCACertificate')
+    if cachedPref('SoftwareRepoCACertificate'):
+        ca_cert_path = cachedPref('SoftwareRepoCACertificate')
     if ca_cert_path == None:
         ca_cert_path = os.path.join(ManagedInstallDir, 'certs', 'ca.pem')
         if not os.path.exists(ca_cert_path):
@@ -2783,20 +3225,95 @@ def getResourceIfChangedAtomically(url,
     client_cert_path = None
     client_key_path = None
     # get client cert if it exists
-    if munkicommon.pref('UseClientCertificate'):
-        client_cert_path = munkicommon.pref('ClientCertificatePath') or None
-        client_key_path = munkicommon.pref('ClientKeyPath') or None
-        if not client_cert_path:
-            for name in ['cert.pem', 'client.pem', 'munki.pem']:
-                client_cert_path = os.path.join(ManagedInstallDir, 'certs',
-                                                name)
-                if os.path.exists(client_cert_path):
-                    break
-    cert_info = {}
-    cert_info['cacert'] = ca_cert_path
-    cert_info['capath'] = ca_dir_path
-    cert_info['cert'] = client_cert_path
-    cert_info['key'] = client_key_path
+    if cachedPref('UseClientCertificate'):
+        client_cert_path = getClientCertPath()
+        client_key_path = cachedPref('ClientKeyPath') or None
+    # fill in CERT_INFO with a single update so other download threads
+    # never see it partly filled in
+    CERT_INFO.update({'cacert': ca_cert_path,
+                      'capath': ca_dir_path,
+                      'cert': client_cert_path,
+                      'key': client_key_path})
+    return CERT_INFO
+
+
+# most downloads we'll run at the same time in fetchResources
+MAX_FETCH_THREADS = 4
+
+
+def fetchResources(resources):
+    '''Downloads a list of (url, destinationpath, message) tuples from the
+    Munki server, several at a time.
+
+    munkistatus and our progress display aren't thread-safe, so when
+    there is more than one resource, the downloads run without their
+    messages or progress display. Callers should display_detail what
+    they are getting instead.
+
+    Returns a list of (changed, error) tuples in the same order as
+    resources; error is the fetch.MunkiDownloadError raised for that
+    resource, or None. Any other exception is re-raised with its original
+    traceback.'''
+    results = [None] * len(resources)
+    failures = []
+    work = Queue.Queue()
+    for index, resource in enumerate(resources):
+        work.put((index, resource))
+    concurrent = len(resources) > 1
+
+    def worker():
+        '''Downloads resources until there are none left'''
+        while True:
+            try:
+                index, (url, destinationpath, message) = work.get_nowait()
+            except Queue.Empty:
+                return
+            if concurrent:
+                message = None
+            try:
+                changed = getResourceIfChangedAtomically(
+                    url, destinationpath, message=message,
+                    show_progress=not concurrent)
+            except fetch.MunkiDownloadError, err:
+                results[index] = (False, err)
+            except Exception:
+                if not concurrent:
+                    raise
+                # not a download failure; keep it to re-raise from the
+                # calling thread
+                failures.append(sys.exc_info())
+                return
+            else:
+                results[index] = (changed, None)
+
+    if not concurrent:
+        # no need for another thread
+        worker()
+    else:
+        threads = [threading.Thread(target=worker)
+                   for unused_i in range(
+                       min(MAX_FETCH_THREADS, len(resources)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if failures:
+        exc_type, exc_value, exc_traceback = failures[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+def getResourceIfChangedAtomically(url,
+                                   destinationpath,
+                                   message=None,
+                                   resume=False,
+                                   expected_hash=None,
+                                   verify=False,
+                                   show_progress=True):
+    '''Gets a given URL from the Munki server. Sets up cert/CA info if it
+    exists, and adds any additional headers'''
+    cert_info = getCertInfo()
 
     # Add any additional headers specified in ManagedInstalls.plist.
     # AdditionalHttpHeaders must be an array of strings with valid HTTP
@@ -2806,8 +3323,7 @@ def getResourceIfChangedAtomically(url,
     #   <string>Key-With-Optional-Dashes: Foo Value</string>
     #   <string>another-custom-header: bar value</string>
     # </array>
-    custom_headers = munkicommon.pref(
-        munkicommon.ADDITIONAL_HTTP_HEADERS_KEY)
+    custom_headers = cachedPref(munkicommon.ADDITIONAL_HTTP_HEADERS_KEY)
 
     return fetch.getResourceIfChangedAtomically(url,
                                                 destinationpath,
@@ -2816,7 +3332,8 @@ def getResourceIfChangedAtomically(url,
                                                 expected_hash=expected_hash,
                                                 message=message,
                                                 resume=resume,
-                                                verify=verify)
+                                                verify=verify,
+                                                show_progress=show_progress)
 
 
 def main():
@@ -0,0 +1,499 @@
+#!/usr/bin/python
+"""
+updatecheck_test.py
+
+Unit tests for updatecheck.
+
+"""
+# Copyright 2011 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import updatecheck
+
+try:
+    import mox
+except ImportError:
+    import sys
+
+    print >> sys.stderr, "mox module is required. run: easy_install mox"
+    raise
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import unittest
+import stubout
+import FoundationPlist
+
+
+class UpdateCheckTestBase(mox.MoxTestBase):
+    """Common setup for updatecheck tests."""
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.stubs = stubout.StubOutForTesting()
+
+    def tearDown(self):
+        self.mox.UnsetStubs()
+        self.stubs.UnsetAll()
+
+    def _StubMunkiDisplay(self):
+        """Silence all munkicommon.display_* methods."""
+        for display in [
+            "percent_done",
+            "status_major",
+            "status_minor",
+            "info",
+            "detail",
+            "debug1",
+            "debug2",
+            "warning",
+            "error",
+        ]:
+            self.stubs.Set(updatecheck.munkicommon, "display_%s" % display,
+                           lambda *args, **kwargs: None)
+
+
+class TestMakeCatalogDB(UpdateCheckTestBase):
+    """Test makeCatalogDB."""
+
+    def setUp(self):
+        UpdateCheckTestBase.setUp(self)
+        self.catalogitems = [
+            {"name": "Foo", "version": "1.0"},
+            {"name": "Foo", "version": "2.0.0"},
+            {"name": "Foo", "version": "1.5"},
+            {"name": "Bar", "version": "1.0"},
+        ]
+        self.pkgdb = updatecheck.makeCatalogDB(self.catalogitems)
+
+    def testNamedTableUsesTrimmedVersions(self):
+        self.assertEqual(self.pkgdb["named"]["Foo"],
+                         {"1.0": [0], "2.0": [1], "1.5": [2]})
+
+    def testLatestTableIsNewestFirst(self):
+        self.assertEqual(self.pkgdb["latest"]["Foo"], [1, 2, 0])
+        self.assertEqual(self.pkgdb["latest"]["Bar"], [3])
+
+    def testLatestTableKeepsCatalogOrderForEqualVersions(self):
+        catalogitems = [
+            {"name": "Foo", "version": "1.0"},
+            {"name": "Foo", "version": "1.0.0"},
+            {"name": "Foo", "version": "0.9"},
+        ]
+        pkgdb = updatecheck.makeCatalogDB(catalogitems)
+        self.assertEqual(pkgdb["latest"]["Foo"], [0, 1, 2])
+
+    def testScalarListKeysAreNormalized(self):
+        catalogitems = [
+            {"name": "Foo", "version": "1.0", "requires": "Bar",
+             "update_for": "Baz", "supported_architectures": "x86_64"},
+            {"name": "Bar", "version": "1.0", "requires": ["Baz"]},
+        ]
+        pkgdb = updatecheck.makeCatalogDB(catalogitems)
+        self.assertEqual(pkgdb["items"][0]["requires"], ["Bar"])
+        self.assertEqual(pkgdb["items"][0]["update_for"], ["Baz"])
+        self.assertEqual(pkgdb["items"][0]["supported_architectures"],
+                         ["x86_64"])
+        self.assertEqual(pkgdb["items"][1]["requires"], ["Baz"])
+        self.assertFalse("update_for" in pkgdb["items"][1])
+
+    def testUpdatersHaveUpdateFor(self):
+        catalogitems = [
+            {"name": "Foo", "version": "1.0"},
+            {"name": "FooUpdate", "version": "1.0", "update_for": "Foo"},
+            {"name": "Bar", "version": "1.0", "update_for": []},
+        ]
+        pkgdb = updatecheck.makeCatalogDB(catalogitems)
+        self.assertEqual(pkgdb["updaters"], [catalogitems[1]])
+        self.assertEqual(pkgdb["updaters"][0]["update_for"], ["Foo"])
+
+    def testRequiredByTable(self):
+        catalogitems = [
+            {"name": "Foo", "version": "1.0", "requires": "Bar"},
+            {"name": "Baz", "version": "1.0", "requires": ["Bar", "Foo-1.0"]},
+            {"name": "Bar", "version": "1.0"},
+        ]
+        pkgdb = updatecheck.makeCatalogDB(catalogitems)
+        self.assertEqual(pkgdb["required_by"],
+                         {"Bar": [0, 1], "Foo-1.0": [1]})
+
+
+class TestTrimVersionString(UpdateCheckTestBase):
+    """Test trimVersionString."""
+
+    def testEmpty(self):
+        self.assertEqual(updatecheck.trimVersionString(None), "")
+        self.assertEqual(updatecheck.trimVersionString(""), "")
+
+    def testMajorMinorUntouched(self):
+        self.assertEqual(updatecheck.trimVersionString("1"), "1")
+        self.assertEqual(updatecheck.trimVersionString("1.0"), "1.0")
+
+    def testTrailingZeroTrimmed(self):
+        self.assertEqual(updatecheck.trimVersionString("1.0.0"), "1.0")
+
+    def testAllTrailingZerosTrimmed(self):
+        self.assertEqual(updatecheck.trimVersionString("10.0.0.0"), "10.0")
+        self.assertEqual(updatecheck.trimVersionString("1.2.3.0.0"), "1.2.3")
+
+    def testOnlyLoneZerosTrimmed(self):
+        self.assertEqual(updatecheck.trimVersionString("1.2.00"), "1.2.00")
+        self.assertEqual(updatecheck.trimVersionString("1.0.10"), "1.0.10")
+        self.assertEqual(updatecheck.trimVersionString("10.0.0.1"),
+                         "10.0.0.1")
+
+    def testEmptyTrailingPartUntouched(self):
+        self.assertEqual(updatecheck.trimVersionString("1.2."), "1.2.")
+
+    def testNonNumericParts(self):
+        self.assertEqual(updatecheck.trimVersionString("10.0.0-abc1"),
+                         "10.0.0-abc1")
+        self.assertEqual(updatecheck.trimVersionString("10.0.0-abc1.0"),
+                         "10.0.0-abc1")
+
+
+class TestProcessRemoval(UpdateCheckTestBase):
+    """Test the dependency checks in processRemoval."""
+
+    def setUp(self):
+        UpdateCheckTestBase.setUp(self)
+        self._StubMunkiDisplay()
+        self.catalogitems = [
+            {"name": "Foo", "version": "2.0", "uninstallable": True,
+             "uninstall_method": "uninstall_script"},
+            {"name": "Foo", "version": "1.0", "requires": ["Bar"],
+             "uninstallable": True, "uninstall_method": "uninstall_script"},
+            {"name": "Foo", "version": "0.5", "requires": ["Bar"],
+             "uninstallable": True, "uninstall_method": "uninstall_script"},
+            {"name": "Bar", "version": "1.0", "uninstallable": True,
+             "uninstall_method": "uninstall_script"},
+            {"name": "Baz", "version": "1.0", "requires": ["Bar-1.0"]},
+            {"name": "Qux", "version": "1.0", "requires": ["Bar--1.0"]},
+            {"name": "Other", "version": "1.0", "requires": ["Foo"]},
+        ]
+        self.stubs.Set(updatecheck, "CATALOG",
+                       {"testing": updatecheck.makeCatalogDB(
+                           self.catalogitems)})
+        self.stubs.Set(updatecheck, "UPDATES_CACHE", {})
+        self.stubs.Set(updatecheck, "VERSION_UPDATES_CACHE", {})
+        self.installinfo = {"processed_installs": [],
+                            "processed_uninstalls": [],
+                            "removals": [],
+                            "_processed_installs": set(),
+                            "_processed_install_names": set(),
+                            "_processed_uninstalls": set()}
+        self.mox.StubOutWithMock(updatecheck, "evidenceThisIsInstalled")
+
+    def testDependentsCheckedByRequiringEntry(self):
+        """Each dependent name is checked once, using the first entry
+        whose requires lists the item, in catalog order."""
+        items = self.catalogitems
+        updatecheck.evidenceThisIsInstalled(items[3]).AndReturn(True)
+        updatecheck.evidenceThisIsInstalled(items[1]).AndReturn(False)
+        updatecheck.evidenceThisIsInstalled(items[4]).AndReturn(False)
+        updatecheck.evidenceThisIsInstalled(items[5]).AndReturn(False)
+        self.mox.ReplayAll()
+        self.assertTrue(updatecheck.processRemoval(
+            "Bar", ["testing"], self.installinfo))
+        self.mox.VerifyAll()
+        self.assertEqual(
+            [item["name"] for item in self.installinfo["removals"]],
+            ["Bar"])
+
+    def testInstalledDependentsRemovedFirst(self):
+        items = self.catalogitems
+        updatecheck.evidenceThisIsInstalled(items[3]).AndReturn(True)
+        updatecheck.evidenceThisIsInstalled(items[1]).AndReturn(True)
+        # processing Foo for removal
+        updatecheck.evidenceThisIsInstalled(items[0]).AndReturn(True)
+        updatecheck.evidenceThisIsInstalled(items[6]).AndReturn(False)
+        # back to Bar's other dependents
+        updatecheck.evidenceThisIsInstalled(items[4]).AndReturn(False)
+        updatecheck.evidenceThisIsInstalled(items[5]).AndReturn(False)
+        self.mox.ReplayAll()
+        self.assertTrue(updatecheck.processRemoval(
+            "Bar", ["testing"], self.installinfo))
+        self.mox.VerifyAll()
+        self.assertEqual(
+            [item["name"] for item in self.installinfo["removals"]],
+            ["Foo", "Bar"])
+
+
+class TestLoadCatalogDB(UpdateCheckTestBase):
+    """Test loadCatalogDB."""
+
+    def setUp(self):
+        UpdateCheckTestBase.setUp(self)
+        self._StubMunkiDisplay()
+        self.tempdir = tempfile.mkdtemp()
+        self.stubs.Set(updatecheck, "PREFS",
+                       {"ManagedInstallDir": self.tempdir})
+        self.catalogpath = os.path.join(self.tempdir, "testing")
+        self.catalogitems = [
+            {"name": "Foo", "version": "1.0"},
+            {"name": "FooUpdate", "version": "1.0", "update_for": ["Foo"]},
+        ]
+        FoundationPlist.writePlist(self.catalogitems, self.catalogpath)
+
+    def tearDown(self):
+        UpdateCheckTestBase.tearDown(self)
+        shutil.rmtree(self.tempdir)
+
+    def _RenameFirstSavedItem(self):
+        """Changes the saved DB, so we can tell if it is reused."""
+        dbpath = os.path.join(updatecheck.getCatalogDBDir(), "testing")
+        saveddb = FoundationPlist.readPlist(dbpath)
+        saveddb["items"][0]["name"] = "Saved"
+        FoundationPlist.writePlist(saveddb, dbpath)
+
+    def testSavesCatalogDB(self):
+        pkgdb = updatecheck.loadCatalogDB(self.catalogpath)
+        self.assertEqual(pkgdb, updatecheck.makeCatalogDB(self.catalogitems))
+        self.assertTrue(os.path.exists(
+            os.path.join(updatecheck.getCatalogDBDir(), "testing")))
+
+    def testReusesSavedDBWhenCatalogUnchanged(self):
+        updatecheck.loadCatalogDB(self.catalogpath)
+        self._RenameFirstSavedItem()
+        pkgdb = updatecheck.loadCatalogDB(self.catalogpath,
+                                          catalogchanged=False)
+        self.assertEqual(pkgdb["items"][0]["name"], "Saved")
+        # updaters are rebuilt from the saved items
+        self.assertEqual(len(pkgdb["updaters"]), 1)
+        self.assertTrue(pkgdb["updaters"][0] is pkgdb["items"][1])
+
+    def testRebuildsWhenCatalogDownloaded(self):
+        updatecheck.loadCatalogDB(self.catalogpath)
+        self._RenameFirstSavedItem()
+        pkgdb = updatecheck.loadCatalogDB(self.catalogpath,
+                                          catalogchanged=True)
+        self.assertEqual(pkgdb["items"][0]["name"], "Foo")
+
+    def testRebuildsWhenCatalogFileChanged(self):
+        updatecheck.loadCatalogDB(self.catalogpath)
+        self._RenameFirstSavedItem()
+        self.catalogitems.append({"name": "Bar", "version": "1.0"})
+        FoundationPlist.writePlist(self.catalogitems, self.catalogpath)
+        pkgdb = updatecheck.loadCatalogDB(self.catalogpath,
+                                          catalogchanged=False)
+        self.assertEqual(pkgdb["items"][0]["name"], "Foo")
+        self.assertEqual(pkgdb["latest"]["Bar"], [2])
+
+    def testRebuildsWhenDBVersionChanged(self):
+        updatecheck.loadCatalogDB(self.catalogpath)
+        self._RenameFirstSavedItem()
+        self.stubs.Set(updatecheck, "CATALOG_DB_VERSION",
+                       updatecheck.CATALOG_DB_VERSION + 1)
+        pkgdb = updatecheck.loadCatalogDB(self.catalogpath,
+                                          catalogchanged=False)
+        self.assertEqual(pkgdb["items"][0]["name"], "Foo")
+
+    def testRebuildsWhenSavedDBUnreadable(self):
+        updatecheck.loadCatalogDB(self.catalogpath)
+        dbpath = os.path.join(updatecheck.getCatalogDBDir(), "testing")
+        fileobj = open(dbpath, "wb")
+        fileobj.write("not a plist")
+        fileobj.close()
+        pkgdb = updatecheck.loadCatalogDB(self.catalogpath,
+                                          catalogchanged=False)
+        self.assertEqual(pkgdb, updatecheck.makeCatalogDB(self.catalogitems))
+
+
+class TestReadManifestPlist(UpdateCheckTestBase):
+    """Test readManifestPlist."""
+
+    def setUp(self):
+        UpdateCheckTestBase.setUp(self)
+        self.stubs.Set(updatecheck, "MANIFEST_DATA_CACHE", {})
+        self.tempdir = tempfile.mkdtemp()
+        self.manifestpath = os.path.join(self.tempdir, "site_default")
+        FoundationPlist.writePlist({"managed_installs": ["Foo"]},
+                                   self.manifestpath)
+
+    def tearDown(self):
+        UpdateCheckTestBase.tearDown(self)
+        shutil.rmtree(self.tempdir)
+
+    def testUnchangedManifestParsedOnce(self):
+        first = updatecheck.readManifestPlist(self.manifestpath)
+        second = updatecheck.readManifestPlist(self.manifestpath)
+        self.assertEqual(first, {"managed_installs": ["Foo"]})
+        self.assertTrue(second is first)
+
+    def testRewrittenManifestParsedAgain(self):
+        first = updatecheck.readManifestPlist(self.manifestpath)
+        FoundationPlist.writePlist({"managed_installs": ["Bar"]},
+                                   self.manifestpath)
+        second = updatecheck.readManifestPlist(self.manifestpath)
+        self.assertFalse(second is first)
+        self.assertEqual(second, {"managed_installs": ["Bar"]})
+
+    def testInvalidManifestNotCached(self):
+        fileobj = open(self.manifestpath, "wb")
+        fileobj.write("not a plist")
+        fileobj.close()
+        self.assertRaises(
+            FoundationPlist.NSPropertyListSerializationException,
+            updatecheck.readManifestPlist, self.manifestpath)
+        self.assertFalse(self.manifestpath in updatecheck.MANIFEST_DATA_CACHE)
+
+
+class TestFetchResources(UpdateCheckTestBase):
+    """Test fetchResources."""
+
+    def setUp(self):
+        UpdateCheckTestBase.setUp(self)
+        self.downloads = []
+        self.stubs.Set(updatecheck, "getResourceIfChangedAtomically",
+                       self._FakeDownload)
+
+    def _FakeDownload(self, url, destinationpath, message=None,
+                      show_progress=True):
+        """Stands in for getResourceIfChangedAtomically."""
+        self.downloads.append((url, message, show_progress))
+        if url == "bad":
+            raise updatecheck.fetch.MunkiDownloadError("download failed")
+        if url == "broken":
+            raise OSError("broken")
+        return url.startswith("changed")
+
+    def _Resources(self, urls):
+        return [(url, "/tmp/%s" % url, "Getting %s..." % url) for url in urls]
+
+    def testResultsInResourceOrder(self):
+        urls = ["changed%s" % i for i in range(5)] + ["same", "changed5"]
+        results = updatecheck.fetchResources(self._Resources(urls))
+        self.assertEqual(results, [(True, None)] * 5 + [(False, None),
+                                                         (True, None)])
+
+    def testDownloadErrorsReturned(self):
+        results = updatecheck.fetchResources(
+            self._Resources(["changed", "bad", "same"]))
+        self.assertEqual(results[0], (True, None))
+        self.assertEqual(results[1][0], False)
+        self.assertTrue(isinstance(results[1][1],
+                                   updatecheck.fetch.MunkiDownloadError))
+        self.assertEqual(results[2], (False, None))
+
+    def _AssertRaisedFromFakeDownload(self, resources):
+        try:
+            updatecheck.fetchResources(resources)
+        except OSError:
+            innermost = traceback.extract_tb(sys.exc_info()[2])[-1]
+            self.assertEqual(innermost[2], "_FakeDownload")
+        else:
+            self.fail("OSError not raised")
+
+    def testOtherErrorsReraisedWithTraceback(self):
+        self._AssertRaisedFromFakeDownload(
+            self._Resources(["changed", "broken", "same"]))
+
+    def testSingleResourceErrorsPropagate(self):
+        self._AssertRaisedFromFakeDownload(self._Resources(["broken"]))
+
+    def testSingleResourceShowsMessageAndProgress(self):
+        updatecheck.fetchResources(self._Resources(["changed"]))
+        self.assertEqual(self.downloads, [("changed", "Getting changed...",
+                                           True)])
+
+    def testConcurrentDownloadsAreQuiet(self):
+        self.mox.StubOutWithMock(updatecheck.munkicommon,
+                                 "display_status_minor")
+        self.mox.ReplayAll()
+        updatecheck.fetchResources(self._Resources(["changed", "same"]))
+        self.mox.VerifyAll()
+        self.assertEqual(sorted(self.downloads), [("changed", None, False),
+                                                  ("same", None, False)])
+
+
+class TestInstallInfoUnchanged(UpdateCheckTestBase):
+    """Test installInfoUnchanged."""
+
+    def setUp(self):
+        UpdateCheckTestBase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.installinfopath = os.path.join(self.tempdir,
+                                            "InstallInfo.plist")
+        self.installinfo = {"managed_installs": [{"name": "Foo"}],
+                            "removals": []}
+        for func_name in ["readPlistFromString", "writePlistToString"]:
+            self.mox.StubOutWithMock(updatecheck.FoundationPlist, func_name)
+
+    def tearDown(self):
+        UpdateCheckTestBase.tearDown(self)
+        shutil.rmtree(self.tempdir)
+
+    def _WriteInstallInfo(self, data):
+        fileobj = open(self.installinfopath, "wb")
+        fileobj.write(data)
+        fileobj.close()
+
+    def testMissingFileIsChanged(self):
+        self.mox.ReplayAll()
+        self.assertFalse(updatecheck.installInfoUnchanged(
+            self.installinfopath, self.installinfo))
+        self.mox.VerifyAll()
+
+    def testSameBytesNotParsed(self):
+        self._WriteInstallInfo("serialized")
+        updatecheck.FoundationPlist.writePlistToString(
+            self.installinfo, binary=True).AndReturn("serialized")
+        self.mox.ReplayAll()
+        self.assertTrue(updatecheck.installInfoUnchanged(
+            self.installinfopath, self.installinfo))
+        self.mox.VerifyAll()
+
+    def testDifferentBytesSameContents(self):
+        self._WriteInstallInfo("reordered")
+        updatecheck.FoundationPlist.writePlistToString(
+            self.installinfo, binary=True).AndReturn("serialized")
+        updatecheck.FoundationPlist.readPlistFromString(
+            "reordered").AndReturn(dict(self.installinfo))
+        self.mox.ReplayAll()
+        self.assertTrue(updatecheck.installInfoUnchanged(
+            self.installinfopath, self.installinfo))
+        self.mox.VerifyAll()
+
+    def testDifferentContents(self):
+        self._WriteInstallInfo("older")
+        updatecheck.FoundationPlist.writePlistToString(
+            self.installinfo, binary=True).AndReturn("serialized")
+        updatecheck.FoundationPlist.readPlistFromString(
+            "older").AndReturn({"managed_installs": [], "removals": []})
+        self.mox.ReplayAll()
+        self.assertFalse(updatecheck.installInfoUnchanged(
+            self.installinfopath, self.installinfo))
+        self.mox.VerifyAll()
+
+    def testUnreadableFileIsChanged(self):
+        self._WriteInstallInfo("garbage")
+        exception = FoundationPlist.NSPropertyListSerializationException
+        updatecheck.FoundationPlist.writePlistToString(
+            self.installinfo, binary=True).AndReturn("serialized")
+        updatecheck.FoundationPlist.readPlistFromString(
+            "garbage").AndRaise(exception("bad plist"))
+        self.mox.ReplayAll()
+        self.assertFalse(updatecheck.installInfoUnchanged(
+            self.installinfopath, self.installinfo))
+        self.mox.VerifyAll()
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__":
+    main()